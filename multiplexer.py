@@ -15,7 +15,9 @@
 # You should have received a copy of the GNU General Public License
 # along with Adblock Plus.  If not, see <http://www.gnu.org/licenses/>.
 
-from sitescripts.web import multiplex
+import argparse
+
+from sitescripts import prefork
 
 try:
     from werkzeug.serving import run_simple
@@ -27,5 +29,32 @@ except ImportError:
         print ' * Running on http://%s:%i/' % server.server_address
         server.serve_forever()
 
+
+def load_multiplex():
+    from sitescripts.web import multiplex
+    return multiplex
+
+
 if __name__ == '__main__':
-    run_simple('localhost', 5000, multiplex, use_reloader=True, use_debugger=True)
+    parser = argparse.ArgumentParser(description='Serve the URL handlers configured in the multiplexer section')
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--port', type=int, default=5000)
+    parser.add_argument('--workers', type=int, default=0,
+                        help='number of pre-forked worker processes, by default a single process development server is run')
+    parser.add_argument('--threads', type=int, default=1,
+                        help='number of threads handling requests in each worker process')
+    parser.add_argument('--max-requests', type=int, default=0,
+                        help='number of requests after which a worker process is replaced')
+    parser.add_argument('--backlog', type=int, default=128,
+                        help='maximum number of pending connections')
+    args = parser.parse_args()
+
+    if args.workers:
+        sock = prefork.create_socket(args.host, args.port, args.backlog)
+        print ' * Running on http://%s:%i/ with %i workers' % (
+            sock.getsockname() + (args.workers,))
+        prefork.serve(sock, load_multiplex, args.workers, args.threads,
+                      args.max_requests)
+    else:
+        run_simple(args.host, args.port, load_multiplex(),
+                   use_reloader=True, use_debugger=True)
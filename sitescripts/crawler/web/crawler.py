@@ -4,7 +4,7 @@ import re
 import json
 import sys
 from sitescripts.utils import cached, get_config
-from sitescripts.web import url_handler, basic_auth
+from sitescripts.web import url_handler, basic_auth, cache_response
 
 
 @cached(600)
@@ -34,6 +34,7 @@ def _fetch_crawlable_sites():
 
 @url_handler('/crawlableSites')
 @basic_auth('crawler')
+@cache_response(600, private=True)
 def crawlable_sites(environ, start_response):
     urls = _fetch_crawlable_sites()
     start_response('200 OK', [('Content-Type', 'text/plain')])
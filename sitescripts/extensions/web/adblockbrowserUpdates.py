@@ -23,7 +23,7 @@ from urlparse import parse_qs
 from jinja2 import Template
 
 from sitescripts.utils import get_config
-from sitescripts.web import url_handler
+from sitescripts.web import url_handler, cache_response
 
 _MANIFEST_TEMPLATE = Template('''<?xml version="1.0"?>
 <updates>
@@ -98,6 +98,7 @@ def _handle_request(environ, start_response, builds_dir, builds_url):
 
 
 @url_handler('/adblockbrowser/updates.xml')
+@cache_response(600, params=['addonVersion'])
 def adblockbrowser_updates(environ, start_response):
     config = get_config()
 
@@ -108,6 +109,7 @@ def adblockbrowser_updates(environ, start_response):
 
 
 @url_handler('/devbuilds/adblockbrowser/updates.xml')
+@cache_response(600, params=['addonVersion'])
 def adblockbrowser_devbuild_updates(environ, start_response):
     config = get_config()
 
@@ -17,7 +17,8 @@ import codecs
 import json
 import time
 
-from sitescripts.notifications.parser import load_notifications
+from sitescripts.notifications.parser import (load_notifications,
+                                              write_notification_bundle)
 from sitescripts.utils import get_config, setupStderr
 
 
@@ -39,3 +40,5 @@ if __name__ == '__main__':
     setupStderr()
     output = get_config().get('notifications', 'output')
     generate_notifications(output)
+    if get_config().has_option('notifications', 'bundle'):
+        write_notification_bundle(get_config().get('notifications', 'bundle'))
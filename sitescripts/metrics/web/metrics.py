@@ -0,0 +1,23 @@
+# This file is part of the Adblock Plus web scripts,
+# Copyright (C) 2006-present eyeo GmbH
+#
+# Adblock Plus is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 3 as
+# published by the Free Software Foundation.
+#
+# Adblock Plus is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Adblock Plus.  If not, see <http://www.gnu.org/licenses/>.
+
+from sitescripts.web import url_handler, basic_auth, format_metrics
+
+
+@url_handler('/metrics')
+@basic_auth('metrics')
+def metrics(environ, start_response):
+    start_response('200 OK', [('Content-Type', 'text/plain; version=0.0.4')])
+    return [format_metrics()]
@@ -15,15 +15,22 @@
 
 import codecs
 import datetime
+import json
 import os
 import re
 import subprocess
 import tarfile
+import tempfile
+import threading
+import time
 import traceback
 from StringIO import StringIO
 
 from sitescripts.utils import get_config
 
+_bundle_format = 1
+_time_format = '%Y-%m-%dT%H:%M'
+
 
 def _parse_targetspec(value, name):
     target = {}
@@ -106,7 +113,7 @@ def _parse_notification(data, name):
         elif key == 'sample' and is_variant:
             current['sample'] = float(value)
         elif key in ['start', 'end']:
-            current[key] = datetime.datetime.strptime(value, '%Y-%m-%dT%H:%M')
+            current[key] = datetime.datetime.strptime(value, _time_format)
         elif key == 'interval':
             current[key] = int(value)
         elif key == 'urls':
@@ -128,9 +135,15 @@ def _parse_notification(data, name):
     return notification
 
 
-def load_notifications():
+def _get_revision():
+    repo = get_config().get('notifications', 'repository')
+    command = ['hg', '-R', repo, 'log', '-r', 'default', '--template', '{node}']
+    return subprocess.check_output(command).strip()
+
+
+def _load_notifications(revision):
     repo = get_config().get('notifications', 'repository')
-    command = ['hg', '-R', repo, 'archive', '-r', 'default', '-t', 'tar',
+    command = ['hg', '-R', repo, 'archive', '-r', revision, '-t', 'tar',
                '-p', '.', '-X', os.path.join(repo, '.hg_archival.txt'), '-']
     data = subprocess.check_output(command)
 
@@ -144,14 +157,162 @@ def load_notifications():
             if fileinfo.type == tarfile.REGTYPE:
                 data = codecs.getreader('utf8')(archive.extractfile(fileinfo))
                 try:
-                    notification = _parse_notification(data, name)
-                    if not 'inactive' in notification:
-                        current_time = datetime.datetime.now()
-                        start = notification.pop('start', current_time)
-                        end = notification.pop('end', current_time)
-                        if not start <= current_time <= end:
-                            notification['inactive'] = True
-                    notifications.append(notification)
+                    notifications.append(_parse_notification(data, name))
                 except:
                     traceback.print_exc()
     return notifications
+
+
+def _apply_schedule(notifications):
+    result = []
+    for notification in notifications:
+        if not 'inactive' in notification:
+            notification = dict(notification)
+            current_time = datetime.datetime.now()
+            start = notification.pop('start', current_time)
+            end = notification.pop('end', current_time)
+            if not start <= current_time <= end:
+                notification['inactive'] = True
+        result.append(notification)
+    return result
+
+
+def load_notifications():
+    return _apply_schedule(_load_notifications('default'))
+
+
+def _convert_times(notification, convert):
+    for item in [notification] + notification.get('variants', []):
+        for key in ('start', 'end'):
+            if key in item:
+                item[key] = convert(item[key])
+
+
+def write_notification_bundle(path):
+    """Write the notifications of the default revision into a bundle.
+
+    The compact bundle is loaded by NotificationBundle. Notifications that are
+    explicitly inactive are only kept as far as needed to retain their groups.
+    """
+    revision = _get_revision()
+    notifications = []
+    for notification in _load_notifications(revision):
+        if notification.get('inactive', False):
+            notification = {'id': notification['id'], 'inactive': True}
+        _convert_times(notification, lambda t: t.strftime(_time_format))
+        notifications.append(notification)
+
+    bundle = {
+        'format': _bundle_format,
+        'version': time.strftime('%Y%m%d%H%M', time.gmtime()),
+        'revision': revision,
+        'notifications': notifications,
+    }
+    handle = tempfile.NamedTemporaryFile(mode='wb', delete=False,
+                                         dir=os.path.dirname(path))
+    with handle:
+        json.dump(bundle, handle, separators=(',', ':'), sort_keys=True)
+    os.chmod(handle.name, 0644)
+    os.rename(handle.name, path)
+
+
+def _read_notification_bundle(path):
+    with open(path, 'rb') as handle:
+        bundle = json.load(handle)
+    if bundle.get('format') != _bundle_format:
+        raise Exception("Unsupported notification bundle format in '%s'" % path)
+
+    notifications = bundle['notifications']
+    for notification in notifications:
+        _convert_times(notification, lambda t: datetime.datetime.strptime(
+            t, _time_format))
+    return bundle['revision'], notifications
+
+
+class NotificationCache(object):
+    """Process-wide cache of the parsed notifications.
+
+    The notifications are only parsed again when the default revision of the
+    repository changes. Checking for a new revision happens in a background
+    thread at most every `max_age` seconds, meanwhile the cached notifications
+    are returned. Only the very first call blocks.
+    """
+
+    def __init__(self, max_age=60):
+        self.max_age = max_age
+        self._lock = threading.Lock()
+        self._revision = None
+        self._notifications = None
+        self._scheduled = None
+        self._last_check = 0
+
+    def get(self):
+        if self._notifications is None:
+            with self._lock:
+                if self._notifications is None:
+                    self._refresh()
+        elif time.time() - self._last_check > self.max_age:
+            if self._lock.acquire(False):
+                thread = threading.Thread(target=self._refresh_in_background)
+                thread.daemon = True
+                thread.start()
+        return self._apply_schedule(self._notifications)
+
+    def _apply_schedule(self, notifications):
+        # Return the same list as before as long as neither the notifications
+        # nor their state changed, so that callers can cache derived data.
+        scheduled = _apply_schedule(notifications)
+        state = [n.get('inactive', False) for n in scheduled]
+        previous = self._scheduled
+        if previous and previous[0] is notifications and previous[1] == state:
+            return previous[2]
+        self._scheduled = (notifications, state, scheduled)
+        return scheduled
+
+    def _refresh(self):
+        revision = _get_revision()
+        if revision != self._revision:
+            self._notifications = _load_notifications(revision)
+            self._revision = revision
+        self._last_check = time.time()
+
+    def _refresh_in_background(self):
+        try:
+            self._refresh()
+        except:
+            # Keep serving the notifications we have, try again later
+            traceback.print_exc()
+            self._last_check = time.time()
+        finally:
+            self._lock.release()
+
+
+class NotificationBundle(NotificationCache):
+    """Notifications read from a bundle written by write_notification_bundle().
+
+    The bundle is loaded again whenever the file changes. Until it has been
+    written the notifications are loaded from the repository, if it goes
+    missing later on the last loaded bundle is kept.
+    """
+
+    def __init__(self, path):
+        super(NotificationBundle, self).__init__()
+        self.path = path
+        self._stat = None
+
+    def get(self):
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            if self._stat is None:
+                return super(NotificationBundle, self).get()
+            return self._apply_schedule(self._notifications)
+
+        key = (stat.st_ino, stat.st_mtime, stat.st_size)
+        if key != self._stat:
+            with self._lock:
+                if key != self._stat:
+                    self._revision, self._notifications = \
+                        _read_notification_bundle(self.path)
+                    self._stat = key
+        return self._apply_schedule(self._notifications)
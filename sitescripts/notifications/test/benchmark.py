@@ -0,0 +1,85 @@
+# This file is part of the Adblock Plus web scripts,
+# Copyright (C) 2006-present eyeo GmbH
+#
+# Adblock Plus is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 3 as
+# published by the Free Software Foundation.
+#
+# Adblock Plus is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Adblock Plus.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Measures requests per second of the /notification.json handler.
+
+Usage: python -m sitescripts.notifications.test.benchmark [notifications]
+
+Mercurial is simulated by a process printing a prepared archive, so actual
+hg invocations (which take considerably longer) are slower than shown here.
+"""
+
+import subprocess
+import sys
+import tempfile
+import time
+
+import mock
+
+import sitescripts.notifications.parser as parser
+import sitescripts.notifications.web.notification as notification
+from sitescripts.notifications.test.parser import _create_notification_archive
+
+NOTIFICATION = '''
+severity = normal
+title.en-US = Title {0}
+title.de-DE = Titel {0}
+message.en-US = Message {0}
+message.de-DE = Nachricht {0}
+links = link{0}
+target = extension=adblockplus extensionVersion>=2.{0}
+target = application=chrome applicationVersion<=6{0}
+[1]
+sample = 0.01
+title.en-US = Variant {0}
+message.en-US = Variant {0}
+'''
+
+
+def fake_hg(archive_path):
+    real_check_output = subprocess.check_output
+
+    def check_output(command):
+        if 'log' in command:
+            return real_check_output(['echo', '0' * 40])
+        return real_check_output(['cat', archive_path])
+    return check_output
+
+
+def requests_per_second(duration=3):
+    environ = {'QUERY_STRING': 'lastVersion=201801010000-1/0-2/1'}
+    count = 0
+    start = time.time()
+    while time.time() - start < duration:
+        notification.notification(environ, lambda *args: None)
+        count += 1
+    return count / (time.time() - start)
+
+
+def benchmark(count=50):
+    files = [(str(i), NOTIFICATION.format(i)) for i in range(count)]
+    with tempfile.NamedTemporaryFile() as archive:
+        archive.write(_create_notification_archive(files))
+        archive.flush()
+
+        with mock.patch('subprocess.check_output', fake_hg(archive.name)):
+            with mock.patch.object(notification, 'load_notifications',
+                                   parser.load_notifications):
+                print 'uncached: %8.1f requests/s' % requests_per_second()
+            print 'cached:   %8.1f requests/s' % requests_per_second()
+
+
+if __name__ == '__main__':
+    benchmark(*map(int, sys.argv[1:]))
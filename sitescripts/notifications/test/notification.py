@@ -384,6 +384,114 @@ class TestNotification(unittest.TestCase):
         }, lambda *args: None))
         self.assertEqual(len(result['notifications']), 0)
 
+    def test_serialized_response(self):
+        self.load_notifications_mock.return_value = [
+            {'id': '1', 'title': {'en-US': u'\u1234'}, 'message': {'en-US': ''}},
+        ]
+        response_header_map = {}
+
+        def start_response(status, response_headers):
+            response_header_map.update(response_headers)
+        body = notification.notification({}, start_response)
+        result = json.loads(body)
+        self.assertEqual(body, json.dumps(result, ensure_ascii=False, indent=2,
+                                          separators=(',', ': '),
+                                          sort_keys=True).encode('utf-8'))
+        self.assertEqual(result['version'],
+                         response_header_map['ABP-Notification-Version'])
+
+    def test_etag(self):
+        self.load_notifications_mock.return_value = [
+            {'id': '1', 'title': {'en-US': ''}, 'message': {'en-US': ''}},
+            {'id': 'a', 'variants': [
+                {'title': {'en-US': ''}, 'message': {'en-US': ''}},
+            ]},
+        ]
+        responses = []
+
+        def request(version, etag=None):
+            environ = {'QUERY_STRING': 'lastVersion=' + version}
+            if etag:
+                environ['HTTP_IF_NONE_MATCH'] = etag
+
+            def start_response(status, response_headers):
+                responses.append((status, dict(response_headers)))
+            body = notification.notification(environ, start_response)
+            return responses[-1] + (body,)
+
+        status, headers, body = request('197001010000-a/0')
+        self.assertEqual(status, '200 OK')
+        etag = headers['ETag']
+
+        status, headers, body = request('197001010000-a/0', etag)
+        self.assertEqual(status, '304 Not Modified')
+        self.assertEqual(body, '')
+
+        status, headers, body = request('197001010000-a/1', etag)
+        self.assertEqual(status, '200 OK')
+        self.assertNotEqual(headers['ETag'], etag)
+
+        self.load_notifications_mock.return_value = [
+            {'id': '2', 'title': {'en-US': ''}, 'message': {'en-US': ''}},
+            {'id': 'a', 'variants': [
+                {'title': {'en-US': ''}, 'message': {'en-US': ''}},
+            ]},
+        ]
+        status, headers, body = request('197001010000-a/0', etag)
+        self.assertEqual(status, '200 OK')
+        self.assertEqual(json.loads(body)['notifications'][0]['id'], '2')
+
+    def test_target_filtering(self):
+        self.load_notifications_mock.return_value = [
+            {'id': '1', 'title': {'en-US': ''}, 'message': {'en-US': ''}},
+            {'id': '2', 'title': {'en-US': ''}, 'message': {'en-US': ''},
+             'targets': [{'extension': 'adblockplus'}]},
+            {'id': '3', 'title': {'en-US': ''}, 'message': {'en-US': ''},
+             'targets': [{'extensionMinVersion': '2.0'},
+                         {'application': 'chrome',
+                          'applicationMaxVersion': '50'}]},
+            {'id': '4', 'title': {'en-US': ''}, 'message': {'en-US': ''},
+             'targets': [{'platformMinVersion': '1.0b1',
+                          'blockedTotalMin': 10}]},
+        ]
+
+        def request(query_string):
+            result = json.loads(notification.notification({
+                'QUERY_STRING': query_string,
+            }, lambda *args: None))
+            return [n['id'] for n in result['notifications']]
+
+        self.assertEqual(request(''), ['1', '2', '3', '4'])
+        self.assertEqual(request('addonName=adblockplus&addonVersion=2.0.0'),
+                         ['1', '2', '3', '4'])
+        self.assertEqual(request('addonName=adblockpluschrome&'
+                                 'addonVersion=1.13&application=chrome&'
+                                 'applicationVersion=50.0.1'),
+                         ['1', '4'])
+        self.assertEqual(request('addonName=adblockpluschrome&'
+                                 'addonVersion=1.13&application=chrome&'
+                                 'applicationVersion=49.0&platform=gecko&'
+                                 'platformVersion=0.5'),
+                         ['1', '3', '4'])
+        self.assertEqual(request('addonVersion=1.13a&applicationVersion=51'),
+                         ['1', '2', '3', '4'])
+
+    def test_target_filtering_variants(self):
+        self.load_notifications_mock.return_value = [
+            {'id': 'a', 'targets': [{'application': 'firefox'}], 'variants': [
+                {'title': {'en-US': ''}, 'message': {'en-US': ''},
+                 'targets': [{'application': 'chrome'}]},
+            ]},
+        ]
+        result = json.loads(notification.notification({
+            'QUERY_STRING': 'lastVersion=197001010000-a/1&application=chrome',
+        }, lambda *args: None))
+        self.assertEqual(len(result['notifications']), 1)
+        result = json.loads(notification.notification({
+            'QUERY_STRING': 'lastVersion=197001010000-a/1&application=opera',
+        }, lambda *args: None))
+        self.assertEqual(len(result['notifications']), 0)
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -15,7 +15,12 @@
 
 import StringIO
 import datetime
+import os
+import shutil
+import subprocess
 import tarfile
+import tempfile
+import threading
 import unittest
 
 import mock
@@ -48,6 +53,8 @@ class TestParser(unittest.TestCase):
         def check_output_side_effect(command):
             if 'hg' in command and 'archive' in command:
                 return _create_notification_archive(self.notification_to_load)
+            if 'hg' in command and 'log' in command:
+                return self.revision + '\n'
         check_output_mock.side_effect = check_output_side_effect
 
     def tearDown(self):
@@ -225,5 +232,143 @@ end = %s
             'locales': ['en-US', 'de-DE']}]
 
 
+class MockRepositoryTestCase(unittest.TestCase):
+    def setUp(self):
+        self.check_output_patcher = mock.patch('subprocess.check_output')
+        self.check_output_mock = self.check_output_patcher.start()
+        self.revision = 'a' * 40
+        self.notifications = {self.revision: [('1', '\ninterval = 1\n')]}
+
+        def check_output_side_effect(command):
+            if 'log' in command:
+                return self.revision + '\n'
+            revision = command[command.index('-r') + 1]
+            return _create_notification_archive(self.notifications[revision])
+        self.check_output_mock.side_effect = check_output_side_effect
+
+    def tearDown(self):
+        self.check_output_patcher.stop()
+
+    def archive_calls(self):
+        return [call for call in self.check_output_mock.call_args_list
+                if 'archive' in call[0][0]]
+
+
+class TestNotificationCache(MockRepositoryTestCase):
+    def wait_for_refresh(self, cache):
+        with cache._lock:
+            pass
+
+    def test_cached(self):
+        cache = parser.NotificationCache()
+        self.assertEqual(cache.get()[0]['interval'], 1)
+        self.assertEqual(cache.get()[0]['interval'], 1)
+        self.assertEqual(len(self.check_output_mock.call_args_list), 2)
+
+    def test_refreshed_in_background(self):
+        cache = parser.NotificationCache(max_age=0)
+        cache.get()
+        self.wait_for_refresh(cache)
+        cache.get()
+        self.wait_for_refresh(cache)
+        self.assertEqual(len(self.archive_calls()), 1)
+
+        self.revision = 'b' * 40
+        self.notifications[self.revision] = [('1', '\ninterval = 2\n')]
+        archive_done = threading.Event()
+        side_effect = self.check_output_mock.side_effect
+
+        def slow_side_effect(command):
+            if 'archive' in command:
+                archive_done.wait()
+            return side_effect(command)
+        self.check_output_mock.side_effect = slow_side_effect
+
+        self.assertEqual(cache.get()[0]['interval'], 1)
+        archive_done.set()
+        self.wait_for_refresh(cache)
+        self.assertEqual(cache.get()[0]['interval'], 2)
+        self.wait_for_refresh(cache)
+        self.assertEqual(len(self.archive_calls()), 2)
+
+    def test_stale_on_error(self):
+        cache = parser.NotificationCache(max_age=0)
+        cache.get()
+        self.wait_for_refresh(cache)
+        self.check_output_mock.side_effect = subprocess.CalledProcessError(
+            255, 'hg')
+        with mock.patch('traceback.print_exc'):
+            self.assertEqual(cache.get()[0]['interval'], 1)
+            self.wait_for_refresh(cache)
+            self.assertEqual(cache.get()[0]['interval'], 1)
+            self.wait_for_refresh(cache)
+
+    def test_schedule_applied_on_every_call(self):
+        current_time = datetime.datetime.now()
+        start_time = current_time + datetime.timedelta(minutes=2)
+        self.notifications[self.revision] = [
+            ('1', '\nstart = %s\n' % _format_time(start_time)),
+        ]
+        cache = parser.NotificationCache()
+        self.assertTrue(cache.get()[0]['inactive'])
+        with mock.patch('datetime.datetime') as datetime_mock:
+            datetime_mock.now.return_value = start_time
+            self.assertNotIn('inactive', cache.get()[0])
+
+
+class TestNotificationBundle(MockRepositoryTestCase):
+    def setUp(self):
+        super(TestNotificationBundle, self).setUp()
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'notifications.bundle')
+
+    def tearDown(self):
+        super(TestNotificationBundle, self).tearDown()
+        shutil.rmtree(self.directory)
+
+    def write_bundle(self, files):
+        self.revision = str(len(self.notifications)) * 40
+        self.notifications[self.revision] = files
+        parser.write_notification_bundle(self.path)
+        # Make sure the change is detected despite coarse mtime resolution
+        os.utime(self.path, (0, len(self.notifications)))
+
+    def test_bundle(self):
+        current_time = datetime.datetime.now()
+        self.write_bundle([
+            ('1', '\ninterval = 1\nstart = %s\n' % _format_time(
+                current_time - datetime.timedelta(hours=1))),
+            ('2', '\ninterval = 2\nend = %s\n' % _format_time(
+                current_time - datetime.timedelta(hours=1))),
+            ('3', '\ninactive = yes\ntitle.en-US = 3\n'),
+        ])
+        bundle = parser.NotificationBundle(self.path)
+        notifications = bundle.get()
+        self.assertEqual(len(notifications), 3)
+        self.assertEqual(notifications[0]['interval'], 1)
+        self.assertNotIn('inactive', notifications[0])
+        self.assertTrue(notifications[1]['inactive'])
+        self.assertEqual(notifications[2], {'id': '3', 'inactive': True})
+        self.assertIs(bundle.get(), notifications)
+        self.assertEqual(len(self.archive_calls()), 1)
+
+        self.write_bundle([('1', '\ninterval = 3\n')])
+        notifications = bundle.get()
+        self.assertEqual(len(notifications), 1)
+        self.assertEqual(notifications[0]['interval'], 3)
+
+    def test_missing_bundle(self):
+        bundle = parser.NotificationBundle(self.path)
+        self.assertEqual(bundle.get()[0]['interval'], 1)
+        self.assertEqual(len(self.archive_calls()), 1)
+
+        self.write_bundle([('1', '\ninterval = 2\n')])
+        self.assertEqual(bundle.get()[0]['interval'], 2)
+
+        os.remove(self.path)
+        self.assertEqual(bundle.get()[0]['interval'], 2)
+        self.assertEqual(len(self.archive_calls()), 2)
+
+
 if __name__ == '__main__':
     unittest.main()
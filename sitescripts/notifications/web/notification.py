@@ -14,13 +14,47 @@
 # along with Adblock Plus.  If not, see <http://www.gnu.org/licenses/>.
 
 import copy
+import hashlib
 import json
 import random
+import re
 import time
 import urlparse
 
-from sitescripts.notifications.parser import load_notifications
-from sitescripts.web import url_handler
+from sitescripts.notifications.parser import (NotificationBundle,
+                                              NotificationCache)
+from sitescripts.utils import get_config
+from sitescripts.web import url_handler, matches_etag
+
+_notification_cache = None
+
+# Serialized responses for the notifications last returned by
+# load_notifications(), keyed by the groups the client is in and the client
+# parameters, along with the target index for these notifications
+_response_cache = (None, {}, {})
+_max_cached_responses = 10000
+
+# Query parameters describing the client, mapped to the target keys
+_client_parameters = {
+    'addonName': 'extension',
+    'addonVersion': 'extensionVersion',
+    'application': 'application',
+    'applicationVersion': 'applicationVersion',
+    'platform': 'platform',
+    'platformVersion': 'platformVersion',
+}
+
+
+def load_notifications():
+    global _notification_cache
+    if _notification_cache is None:
+        config = get_config()
+        if config.has_option('notifications', 'bundle'):
+            path = config.get('notifications', 'bundle')
+            _notification_cache = NotificationBundle(path)
+        else:
+            _notification_cache = NotificationCache()
+    return _notification_cache.get()
 
 
 def _determine_groups(version, notifications):
@@ -97,26 +131,151 @@ def _get_notifications_to_send(notifications, groups):
     return notifications_to_send
 
 
-def _create_response(notifications, groups):
-    return {
-        'version': _generate_version(groups),
-        'notifications': _get_notifications_to_send(notifications, groups),
-    }
+def _parse_version(version):
+    # Only plain numeric versions can be compared reliably here, everything
+    # else is left to the client.
+    if not re.search(r'^\d+(\.\d+)*$', version):
+        return None
+    parts = [int(part) for part in version.split('.')]
+    while len(parts) > 1 and parts[-1] == 0:
+        parts.pop()
+    return tuple(parts)
+
+
+def _compile_target(target):
+    compiled = []
+    for key in ('extension', 'application', 'platform'):
+        compiled.append((
+            key,
+            target.get(key),
+            _parse_version(target.get(key + 'MinVersion', '')),
+            _parse_version(target.get(key + 'MaxVersion', '')),
+        ))
+    return compiled
+
+
+def _build_target_index(notifications):
+    """Map (notification id, variant) to the variant's compiled targets.
+
+    Variants that aren't targeted map to None.
+    """
+    index = {}
+    for notification in notifications:
+        targets = notification.get('targets')
+        index[notification['id'], 0] = targets
+        for i, variant in enumerate(notification.get('variants', [])):
+            index[notification['id'], i + 1] = variant.get('targets', targets)
+    for key, targets in index.iteritems():
+        if targets:
+            index[key] = [_compile_target(target) for target in targets]
+        else:
+            index[key] = None
+    return index
+
+
+def _matches_target(target, client):
+    for key, name, min_version, max_version in target:
+        if name is not None and key in client and client[key] != name:
+            return False
+        version = client.get(key + 'Version')
+        if version is None:
+            continue
+        if min_version is not None and version < min_version:
+            return False
+        if max_version is not None and version > max_version:
+            return False
+    return True
+
+
+def _matches_client(targets, client):
+    if targets is None:
+        return True
+    return any(_matches_target(target, client) for target in targets)
+
+
+def _get_client(params):
+    """Return the client properties given in the query string.
+
+    Versions that cannot be compared are omitted.
+    """
+    client = {}
+    for param, key in _client_parameters.iteritems():
+        value = params.get(param, [''])[0]
+        if key.endswith('Version'):
+            value = _parse_version(value)
+        if value:
+            client[key] = value
+    return client
+
+
+def _serialize_response(notifications, groups, client, target_index):
+    """Serialize the response for the given groups with an empty version.
+
+    Notifications that cannot target the client are left out. Returns the response up to and after the version, as well as an ETag.
+    """
+    notifications = _get_notifications_to_send(notifications, groups)
+    if client:
+        variants = {group['id']: group['variant'] for group in groups}
+        notifications = [
+            notification for notification in notifications
+            if _matches_client(target_index.get((notification['id'],
+                                                 variants.get(notification['id'], 0))),
+                               client)
+        ]
+    response = {'version': '', 'notifications': notifications}
+    data = json.dumps(response, ensure_ascii=False, indent=2,
+                      separators=(',', ': '), sort_keys=True).encode('utf-8')
+    # Version is the last key, so this is its value
+    position = data.rindex('""')
+    prefix, suffix = data[:position], data[position + 2:]
+
+    etag = hashlib.md5(prefix + suffix)
+    for group in groups:
+        etag.update('-%s/%s' % (group['id'], group['variant']))
+    return prefix, suffix, '"%s"' % etag.hexdigest()
+
+
+def _get_serialized_response(all_notifications, notifications, groups, client):
+    global _response_cache
+    cached_notifications, responses, target_index = _response_cache
+    if (cached_notifications is not all_notifications or
+            len(responses) >= _max_cached_responses):
+        responses = {}
+        if cached_notifications is not all_notifications:
+            target_index = _build_target_index(all_notifications)
+        _response_cache = (all_notifications, responses, target_index)
+
+    key = (tuple((group['id'], group['variant']) for group in groups),
+           tuple(sorted(client.iteritems())))
+    if key not in responses:
+        responses[key] = _serialize_response(notifications, groups, client,
+                                             target_index)
+    return responses[key]
 
 
 @url_handler('/notification.json')
 def notification(environ, start_response):
     params = urlparse.parse_qs(environ.get('QUERY_STRING', ''))
     version = params.get('lastVersion', [''])[0]
-    notifications = load_notifications()
-    groups = _determine_groups(version, notifications)
-    notifications = [x for x in notifications if not x.get('inactive', False)]
+    all_notifications = load_notifications()
+    groups = _determine_groups(version, all_notifications)
+    notifications = [x for x in all_notifications
+                     if not x.get('inactive', False)]
     _assign_groups(groups, notifications)
-    response = _create_response(notifications, groups)
+    client = _get_client(params)
+    prefix, suffix, etag = _get_serialized_response(all_notifications,
+                                                    notifications, groups,
+                                                    client)
+    version = _generate_version(groups)
+
+    if matches_etag(environ, etag):
+        start_response('304 Not Modified', [('ETag', etag)])
+        return ''
+
     response_headers = [('Content-Type', 'application/json; charset=utf-8'),
-                        ('ABP-Notification-Version', response['version'])]
-    response_body = json.dumps(response, ensure_ascii=False, indent=2,
-                               separators=(',', ': '),
-                               sort_keys=True).encode('utf-8')
+                        ('ABP-Notification-Version', version),
+                        ('ETag', etag)]
+    response_body = (prefix + json.dumps(version, ensure_ascii=False).encode('utf-8') +
+                     suffix)
     start_response('200 OK', response_headers)
     return response_body
@@ -0,0 +1,166 @@
+# This file is part of the Adblock Plus web scripts,
+# Copyright (C) 2006-present eyeo GmbH
+#
+# Adblock Plus is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 3 as
+# published by the Free Software Foundation.
+#
+# Adblock Plus is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Adblock Plus.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Pre-forking WSGI server.
+
+The master process binds the listening socket and supervises the worker
+processes. The WSGI app is only loaded in the workers after they have been
+forked, so that workers started on reload pick up changed code and
+configuration.
+
+Signals handled by the master process:
+
+SIGHUP          start new workers, let the old ones finish their requests
+SIGTERM, SIGINT let the workers finish their requests, then exit
+"""
+
+import errno
+import itertools
+import os
+import select
+import signal
+import socket
+import sys
+import threading
+import time
+import traceback
+from wsgiref.simple_server import WSGIServer, WSGIRequestHandler
+
+
+def create_socket(host, port, backlog=128):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, port))
+    sock.listen(backlog)
+
+    # All workers wait for connections on this socket, the ones not getting
+    # a connection mustn't block in accept().
+    sock.setblocking(0)
+    return sock
+
+
+def _create_server(sock, app):
+    server = WSGIServer(sock.getsockname(), WSGIRequestHandler,
+                        bind_and_activate=False)
+    server.socket = sock
+    server.server_address = sock.getsockname()
+    server.server_name = socket.getfqdn(server.server_address[0])
+    server.server_port = server.server_address[1]
+    server.setup_environ()
+    server.set_app(app)
+    return server
+
+
+def _run_worker(sock, load_app, threads, max_requests):
+    stopping = threading.Event()
+    signal.signal(signal.SIGTERM, lambda signum, frame: stopping.set())
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGHUP, signal.SIG_IGN)
+
+    app = load_app()
+    counter = itertools.count(1)
+
+    def counting_app(environ, start_response):
+        if max_requests and next(counter) >= max_requests:
+            stopping.set()
+        return app(environ, start_response)
+
+    server = _create_server(sock, counting_app)
+
+    # SocketServer's handle_request() would use the timeout of the
+    # non-blocking socket (zero) and spin, so wait for connections here,
+    # waking up regularly to notice when the worker is supposed to stop.
+    def serve():
+        while not stopping.is_set():
+            try:
+                readable = select.select([sock], [], [], 1)[0]
+            except select.error as error:
+                if error.args[0] != errno.EINTR:
+                    raise
+                continue
+            if readable and not stopping.is_set():
+                server._handle_request_noblock()
+
+    pool = [threading.Thread(target=serve) for i in range(threads - 1)]
+    for thread in pool:
+        thread.start()
+    serve()
+    for thread in pool:
+        thread.join()
+
+
+def _spawn_worker(sock, load_app, threads, max_requests):
+    pid = os.fork()
+    if pid == 0:
+        status = 0
+        try:
+            _run_worker(sock, load_app, threads, max_requests)
+        except Exception:
+            traceback.print_exc()
+            status = 1
+        finally:
+            sys.stderr.flush()
+            os._exit(status)
+    return pid
+
+
+def serve(sock, load_app, workers=4, threads=1, max_requests=0):
+    """Serve the WSGI app returned by load_app() on the given socket.
+
+    Each worker process handles requests in the given number of threads.
+    After a worker handled max_requests requests (if non-zero), it exits
+    and a new worker is started. Returns after all workers exited, when
+    SIGTERM or SIGINT was received.
+    """
+    signals = []
+    for signum in [signal.SIGHUP, signal.SIGTERM, signal.SIGINT]:
+        signal.signal(signum, lambda signum, frame: signals.append(signum))
+
+    def spawn():
+        children.add(_spawn_worker(sock, load_app, threads, max_requests))
+
+    children = set()
+    retiring = set()
+    stopping = False
+    for i in range(workers):
+        spawn()
+
+    while children:
+        while signals:
+            signum = signals.pop(0)
+            if signum == signal.SIGHUP and not stopping:
+                retiring.update(children)
+                for i in range(workers):
+                    spawn()
+            else:
+                stopping = True
+                retiring.update(children)
+            for pid in retiring & children:
+                os.kill(pid, signal.SIGTERM)
+
+        pid, status = os.waitpid(-1, os.WNOHANG)
+        if pid == 0:
+            # Interrupted by signals, so these don't have to wait
+            time.sleep(1)
+            continue
+
+        children.discard(pid)
+        if pid in retiring:
+            retiring.discard(pid)
+        elif not stopping:
+            if status != 0:
+                # Don't restart a failing worker over and over again
+                time.sleep(1)
+            spawn()
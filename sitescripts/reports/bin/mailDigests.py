@@ -24,7 +24,7 @@ from email.utils import parseaddr
 from sitescripts.utils import get_config, setupStderr
 from sitescripts.templateFilters import formatmime
 from email.utils import formataddr
-from sitescripts.reports.utils import mailDigest, getReports, getReportSubscriptions, calculateReportSecret, getDigestId, getDigestSecret, getUserUsefulnessScore
+from sitescripts.reports.utils import mailDigests, getDigestReports, calculateReportSecret, getDigestId, getDigestSecret
 import sitescripts.subscriptions.subscriptionParser as subscriptionParser
 
 
@@ -54,10 +54,10 @@ def scanReports():
 
     result = []
 
-    for dbreport in getReports(startTime):
+    for dbreport in getDigestReports(startTime):
         matchSubscriptions = {}
         recipients = []
-        reportSubscriptions = getReportSubscriptions(dbreport['guid'])
+        reportSubscriptions = dbreport['sublists']
         if dbreport['type'] == 'false positive' or dbreport['type'] == 'false negative':
             for subscription in reportSubscriptions:
                 subscriptionID = subscription.get('url', 'unknown')
@@ -97,8 +97,16 @@ def scanReports():
 def sendNotifications(reports):
     global subscriptionList
 
+    reportsBySubscription = {}
+    for report in reports:
+        # Subscriptions can be dicts which aren't hashable, and a report can
+        # list the same subscription more than once, for several of its URLs.
+        for subscriptionKey in set(map(id, report['subscriptions'])):
+            reportsBySubscription.setdefault(subscriptionKey, []).append(report)
+
+    mails = []
     for subscription in subscriptionList:
-        selectedReports = filter(lambda report: subscription in report['subscriptions'], reports)
+        selectedReports = reportsBySubscription.get(id(subscription), [])
         if len(selectedReports) == 0:
             continue
 
@@ -124,10 +132,12 @@ def sendNotifications(reports):
         for group in groups:
             group['reports'].sort(lambda a, b: -cmp(a['weight'], b['weight']))
 
-        sendMail(subscription, groups)
+        mails.append(getMailData(subscription, groups))
+
+    mailDigests(mails)
 
 
-def sendMail(subscription, groups):
+def getMailData(subscription, groups):
     if hasattr(subscription, 'email'):
         email = subscription.email
     else:
@@ -139,7 +149,7 @@ def sendMail(subscription, groups):
     id = getDigestId(address)
     digestLink = get_config().get('reports', 'urlRoot') + 'digest?id=%s&secret=%s' % (id, getDigestSecret(id, date.today().isocalendar()))
 
-    mailDigest({'email': email, 'digestLink': digestLink, 'subscription': subscription, 'groups': groups})
+    return {'email': email, 'digestLink': digestLink, 'subscription': subscription, 'groups': groups}
 
 
 def calculateReportWeight(report, subscriptions):
@@ -159,8 +169,7 @@ def calculateReportWeight(report, subscriptions):
             weight -= 0.5
         elif re.search(r'\S', report['comment']):
             weight += 0.5
-    if report['contact'] != None:
-        weight += getUserUsefulnessScore(report['contact'])
+    weight += report['score']
 
     weight += (report['ctime'] - startTime) / (currentTime - startTime) * 0.2
     return weight
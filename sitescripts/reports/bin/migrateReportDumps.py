@@ -0,0 +1,68 @@
+# This file is part of the Adblock Plus web scripts,
+# Copyright (C) 2006-present eyeo GmbH
+#
+# Adblock Plus is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 3 as
+# published by the Free Software Foundation.
+#
+# Adblock Plus is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Adblock Plus.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Re-encode report dumps that are still stored in the legacy format."""
+
+import argparse
+import time
+
+from sitescripts.utils import setupStderr
+from sitescripts.reports.dump import encode_report, decode_report, is_current
+from sitescripts.reports.utils import get_db, executeQuery
+
+
+def migrate_report_dumps(batch_size=500, pause=0):
+    """Convert all legacy report dumps, committing after every batch."""
+    db = get_db()
+    cursor = db.cursor()
+    last_guid = ''
+    migrated = 0
+    while True:
+        executeQuery(cursor,
+                     'SELECT guid, dump FROM #PFX#reports WHERE guid > %s '
+                     'ORDER BY guid LIMIT %s',
+                     (last_guid, batch_size))
+        rows = cursor.fetchall()
+        if not rows:
+            break
+
+        for guid, dump in rows:
+            if dump and not is_current(dump):
+                executeQuery(cursor,
+                             'UPDATE #PFX#reports SET dump = _binary %s '
+                             'WHERE guid = %s',
+                             (encode_report(decode_report(dump)), guid))
+                migrated += 1
+        db.commit()
+        last_guid = rows[-1][0]
+
+        if pause:
+            time.sleep(pause)
+    cursor.close()
+    return migrated
+
+
+if __name__ == '__main__':
+    setupStderr()
+
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--batch-size', type=int, default=500,
+                        help='Number of reports to convert per transaction')
+    parser.add_argument('--pause', type=float, default=0,
+                        help='Seconds to sleep between batches, to limit '
+                             'the load on the database')
+    args = parser.parse_args()
+    print '%i report dumps converted' % migrate_report_dumps(args.batch_size,
+                                                             args.pause)
@@ -21,32 +21,32 @@ import re
 from time import time
 from email.utils import parseaddr
 from sitescripts.utils import get_config, get_template, setupStderr
-from sitescripts.reports.utils import getReport, saveReport, get_db, executeQuery
-
-
-def getReports():
-    count = 1000
-    offset = 0
-    while True:
-        cursor = get_db().cursor(MySQLdb.cursors.DictCursor)
-        executeQuery(cursor, 'SELECT guid FROM #PFX#reports WHERE hasscreenshot > 0 LIMIT %s OFFSET %s', (count, offset))
-        rows = cursor.fetchall()
-        cursor.close()
-        if len(rows) == 0:
-            break
-        for row in rows:
-            yield row
-        offset += len(rows)
+from sitescripts.reports.utils import getReport, saveReport, iterReports
+from sitescripts.reports.screenshots import optimize_screenshots
 
 
 def processReports():
-    for report in getReports():
+    # Reports that were saved before screenshots were split off the dump
+    for report in iterReports('hasscreenshot > 0', columns=['guid'], batchSize=1000):
         guid = report.get('guid', None)
         reportData = getReport(guid)
         if 'screenshot' in reportData:
             saveReport(guid, reportData)
 
 
+def optimizeScreenshots():
+    config = get_config()
+    if not config.has_option('reports', 'pngOptimizerPath'):
+        return
+    workers = 2
+    if config.has_option('reports', 'pngOptimizerWorkers'):
+        workers = config.getint('reports', 'pngOptimizerWorkers')
+    optimize_screenshots(config.get('reports', 'dataPath'),
+                         config.get('reports', 'pngOptimizerPath').split(),
+                         workers)
+
+
 if __name__ == '__main__':
     setupStderr()
     processReports()
+    optimizeScreenshots()
@@ -13,18 +13,57 @@
 # You should have received a copy of the GNU General Public License
 # along with Adblock Plus.  If not, see <http://www.gnu.org/licenses/>.
 
-import MySQLdb
-from sitescripts.utils import setupStderr
-from sitescripts.reports.utils import get_db, executeQuery, removeReport
+import argparse
+from multiprocessing.pool import ThreadPool
+from time import time
+from sitescripts.utils import get_config, setupStderr
+from sitescripts.reports.utils import get_db, executeQuery, removeReports, removeReportFiles
+from sitescripts.reports.screenshots import remove_unreferenced
 
 
-def removeOldReports(days=30):
-    cursor = get_db().cursor(MySQLdb.cursors.DictCursor)
-    executeQuery(cursor, 'SELECT guid FROM #PFX#reports WHERE ADDDATE(ctime, INTERVAL %s DAY) < NOW()', days)
-    for report in cursor:
-        removeReport(report['guid'])
+def removeOldReports(days=30, batch_size=1000, time_budget=None, workers=4):
+    start_time = time()
+    removed = 0
+    cursor = get_db().cursor()
+    pool = ThreadPool(workers)
+    try:
+        while time_budget is None or time() - start_time < time_budget:
+            executeQuery(cursor,
+                         'SELECT guid FROM #PFX#reports WHERE ctime < NOW() - INTERVAL %s DAY ORDER BY ctime LIMIT %s',
+                         (days, batch_size))
+            guids = [guid for guid, in cursor.fetchall()]
+            if len(guids) == 0:
+                break
+
+            removeReports(guids)
+            pool.map(removeReportFiles, guids)
+            removed += len(guids)
+        else:
+            print 'Time budget of %is exhausted, leaving the remaining reports for the next run' % time_budget
+    finally:
+        pool.close()
+        pool.join()
+        cursor.close()
+
+    screenshots = remove_unreferenced(get_config().get('reports', 'dataPath'))
+
+    duration = time() - start_time
+    print 'Removed %i reports and %i screenshots in %.1fs (%.1f reports/s)' % (
+        removed, screenshots, duration, removed / duration if duration else 0)
+    return removed
 
 
 if __name__ == '__main__':
     setupStderr()
-    removeOldReports()
+
+    parser = argparse.ArgumentParser(description='Remove the reports older than the given number of days.')
+    parser.add_argument('--days', type=int, default=30,
+                        help='Age in days after which reports expire')
+    parser.add_argument('--batch-size', type=int, default=1000,
+                        help='Number of reports to remove per transaction')
+    parser.add_argument('--time-budget', type=float,
+                        help='Seconds after which no further batches are started')
+    parser.add_argument('--workers', type=int, default=4,
+                        help='Number of threads removing report files')
+    args = parser.parse_args()
+    removeOldReports(args.days, args.batch_size, args.time_budget, args.workers)
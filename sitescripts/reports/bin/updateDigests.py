@@ -21,7 +21,7 @@ import re
 from time import time
 from email.utils import parseaddr
 from sitescripts.utils import get_config, get_template, setupStderr
-from sitescripts.reports.utils import getReports, getReportSubscriptions, calculateReportSecret, getDigestPath, getUserUsefulnessScore
+from sitescripts.reports.utils import getDigestReports, calculateReportSecret, getDigestPath
 import sitescripts.subscriptions.subscriptionParser as subscriptionParser
 
 
@@ -42,7 +42,7 @@ def updateDigests(dir):
             emails[email] = []
 
     startTime = currentTime - get_config().getint('reports', 'digestDays') * 24 * 60 * 60
-    for dbreport in getReports(startTime):
+    for dbreport in getDigestReports(startTime):
         report = {
             'guid': dbreport['guid'],
             'status': dbreport['status'],
@@ -52,14 +52,14 @@ def updateDigests(dir):
             'type': dbreport['type'],
             'subscriptions': [],
             'contact': dbreport['contact'],
-            'score': getUserUsefulnessScore(dbreport['contact']),
+            'score': dbreport['score'],
             'hasscreenshot': dbreport['hasscreenshot'],
             'knownIssues': dbreport['knownissues'],
             'time': dbreport['ctime'],
         }
 
         recipients = set()
-        reportSubscriptions = getReportSubscriptions(dbreport['guid'])
+        reportSubscriptions = dbreport['sublists']
 
         if dbreport['type'] == 'false positive' or dbreport['type'] == 'false negative':
             for subscription in reportSubscriptions:
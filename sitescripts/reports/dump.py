@@ -0,0 +1,43 @@
+# This file is part of the Adblock Plus web scripts,
+# Copyright (C) 2006-present eyeo GmbH
+#
+# Adblock Plus is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 3 as
+# published by the Free Software Foundation.
+#
+# Adblock Plus is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Adblock Plus.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Encode and decode the report dumps stored in the database."""
+
+import marshal
+import zlib
+
+# Legacy dumps are plain marshal data of a dict and hence always start with
+# marshal's dict type code, which never collides with a version byte.
+LEGACY_PREFIX = '{'
+VERSION = '\x01'
+
+
+def encode_report(data):
+    """Serialize the report data into the current dump format."""
+    return VERSION + zlib.compress(marshal.dumps(data), 6)
+
+
+def decode_report(dump):
+    """Deserialize a report dump of any format version."""
+    if dump.startswith(VERSION):
+        return marshal.loads(zlib.decompress(dump[1:]))
+    if dump.startswith(LEGACY_PREFIX):
+        return marshal.loads(dump)
+    raise ValueError('Unknown report dump format')
+
+
+def is_current(dump):
+    """Check whether a report dump is already in the current format."""
+    return dump.startswith(VERSION)
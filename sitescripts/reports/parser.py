@@ -0,0 +1,307 @@
+# This file is part of the Adblock Plus web scripts,
+# Copyright (C) 2006-present eyeo GmbH
+#
+# Adblock Plus is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 3 as
+# published by the Free Software Foundation.
+#
+# Adblock Plus is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Adblock Plus.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Reentrant parser for the XML reports submitted by Adblock Plus."""
+
+import json
+import os
+import re
+from time import time
+from urlparse import urlparse
+from xml.parsers.expat import ParserCreate, ExpatError, ErrorString
+
+LENGTH_RESTRICTIONS = {
+    'default_string': 1024,
+    'default_list': 512,
+    'abp_version': 32,
+    'abp_locale': 32,
+    'app_name': 32,
+    'app_vendor': 32,
+    'app_version': 32,
+    'platform_name': 32,
+    'platform_version': 32,
+    'platform_build': 32,
+    'requests.type': 32,
+    'requests.size': 32,
+    'filters.hitCount': 16,
+    'subscriptions.lastDownloadAttempt': 16,
+    'subscriptions.lastDownloadSuccess': 16,
+    'subscriptions.softExpiration': 16,
+    'subscriptions.hardExpiration': 16,
+    'subscriptions.downloadStatus': 32,
+    'errors': 16,
+    'errors.type': 16,
+    'errors.line': 16,
+    'errors.column': 16,
+    'extensions.version': 32,
+    'extensions.type': 32,
+    'email': 256,
+    'screenshot': 1024 * 1024,
+}
+
+OPTIONS = {
+    'enabled': 'option_enabled',
+    'objecttabs': 'option_objecttabs',
+    'collapse': 'option_collapse',
+    'privateBrowsing': 'option_privateBrowsing',
+    'subscriptionsAutoUpdate': 'option_subscriptionsAutoUpdate',
+    'javascript': 'option_javascript',
+}
+
+TEXT_FIELDS = {'screenshot', 'comment', 'email'}
+
+
+def translate_subscription_name(name):
+    """Return the display name of a user-defined filter list."""
+    if name == '~fl~':
+        return 'My Ad Blocking Rules'
+    elif name == '~wl~':
+        return 'My Exception Rules'
+    elif name == '~eh~':
+        return 'My Element Hiding Rules'
+    elif name == '~il~':
+        return 'My Invalid Rules'
+    elif name.startswith('~external~'):
+        return 'External: ' + name[len('~external~'):]
+    return name
+
+
+def known_issues_path(xml_path):
+    """Return the path of the known issues stored for a report file."""
+    return os.path.splitext(xml_path)[0] + '.knownIssues.json'
+
+
+def save_known_issues(xml_path, urls):
+    """Store the known issues URLs matched for a report next to its file."""
+    with open(known_issues_path(xml_path), 'wb') as file:
+        json.dump(urls, file)
+
+
+def load_known_issues(xml_path):
+    """Return the known issues URLs stored for a report, or None."""
+    try:
+        with open(known_issues_path(xml_path), 'rb') as file:
+            return json.load(file)
+    except (IOError, ValueError):
+        return None
+
+
+class ReportParser(object):
+    """Collect the data of a single report from its XML.
+
+    All state lives on the instance, so any number of parsers can run
+    side by side, in threads or in worker processes. If a known issues
+    MatchState is given, each element is also passed to it.
+    """
+
+    def __init__(self, known_issues=None):
+        self.data = {
+            'status': '',
+            'usefulness': 0,
+            'warnings': {},
+            'requests': [],
+            'filters': [],
+            'subscriptions': [],
+            'extensions': [],
+            'errors': [],
+            'time': time(),
+        }
+        self._tag_stack = []
+        self.known_issues = known_issues
+        # The element whose text is still collected for known issues
+        self._element = None
+
+    def parse(self, source):
+        """Parse the report XML read from the file object `source`."""
+        parser = ParserCreate()
+        parser.StartElementHandler = self._start_element
+        parser.EndElementHandler = self._end_element
+        parser.CharacterDataHandler = self._text
+        try:
+            parser.ParseFile(source)
+        except ExpatError as error:
+            self.data['warnings']['!parsing'] = (
+                'Parsing error in the report: %s at line %i column %i' %
+                (ErrorString(error.code), error.lineno, error.offset)
+            )
+        self._flush_element()
+
+        data = self.data
+        if not data.get('screenshot', 'data:image/').startswith('data:image/'):
+            del data['screenshot']
+        email = data.get('email')
+        if email is not None and ' at ' not in email and '@' not in email:
+            del data['email']
+        return data
+
+    def validate(self):
+        """Truncate the fields exceeding their length restrictions."""
+        self._validate(self.data, None)
+        return self.data
+
+    def _validate(self, data, path):
+        if path == 'warnings':
+            return
+
+        warnings = self.data['warnings']
+        for key in data:
+            key_path = key if path is None else path + '.' + key
+            value = data[key]
+            if isinstance(value, dict):
+                self._validate(value, key_path)
+            elif isinstance(value, list):
+                limit = LENGTH_RESTRICTIONS.get(
+                    key_path, LENGTH_RESTRICTIONS['default_list'],
+                )
+                if len(value) > limit:
+                    value = data[key] = value[:limit]
+                    warnings[key_path] = ('List %s exceeded length limit '
+                                          'and was truncated' % key_path)
+                item_path = key_path + '.item'
+                item_limit = LENGTH_RESTRICTIONS.get(
+                    item_path, LENGTH_RESTRICTIONS['default_string'],
+                )
+                for i, item in enumerate(value):
+                    if isinstance(item, dict):
+                        self._validate(item, key_path)
+                    elif (isinstance(item, basestring) and
+                          len(item) > item_limit):
+                        value[i] = item[:item_limit] + u'\u2026'
+                        warnings[item_path] = ('Field %s exceeded length '
+                                               'limit and was truncated' %
+                                               item_path)
+            elif isinstance(value, basestring):
+                limit = LENGTH_RESTRICTIONS.get(
+                    key_path, LENGTH_RESTRICTIONS['default_string'],
+                )
+                if len(value) > limit:
+                    data[key] = value[:limit] + u'\u2026'
+                    warnings[key_path] = ('Field %s exceeded length limit '
+                                          'and was truncated' % key_path)
+
+    def _start_element(self, name, attributes):
+        if self.known_issues is not None:
+            self._flush_element()
+            self._element = (name, attributes, [])
+
+        data = self.data
+        if name == 'report':
+            data['type'] = attributes.get('type', 'unknown')
+        elif name == 'adblock-plus':
+            data['abp_version'] = attributes.get('version', 'unknown')
+            if data['abp_version'] == '99.9':
+                data['abp_version'] = 'development environment'
+            data['abp_locale'] = attributes.get('locale', 'unknown')
+        elif name == 'application':
+            data['app_name'] = attributes.get('name', 'unknown')
+            data['app_vendor'] = attributes.get('vendor', 'unknown')
+            data['app_version'] = attributes.get('version', 'unknown')
+            data['app_ua'] = attributes.get('userAgent', 'unknown')
+        elif name == 'platform':
+            data['platform_name'] = attributes.get('name', 'unknown')
+            data['platform_version'] = attributes.get('version', 'unknown')
+            data['platform_build'] = attributes.get('build', 'unknown')
+        elif name == 'window':
+            data['main_url'] = attributes.get('url', 'unknown')
+            try:
+                data['siteName'] = urlparse(data['main_url']).netloc
+            except ValueError:
+                pass
+            if not data.get('siteName'):
+                data['siteName'] = 'unknown'
+            data['opener'] = attributes.get('opener', '')
+            data['referrer'] = attributes.get('referrer', '')
+        elif name == 'request':
+            try:
+                count = int(attributes['count'])
+            except (KeyError, ValueError):
+                count = 1
+            data['requests'].append({
+                'location': attributes.get('location', ''),
+                'type': attributes.get('type', 'unknown'),
+                'docDomain': attributes.get('docDomain', 'unknown'),
+                'thirdParty': attributes.get('thirdParty', 'false') == 'true',
+                'size': attributes.get('size', ''),
+                'filter': attributes.get('filter', ''),
+                'count': count,
+                'tagName': attributes.get('node', ''),
+            })
+        elif name == 'filter':
+            subscriptions = attributes.get('subscriptions', 'unknown')
+            data['filters'].append({
+                'text': attributes.get('text', 'unknown'),
+                'subscriptions': map(translate_subscription_name,
+                                     subscriptions.split(' ')),
+                'hitCount': attributes.get('hitCount', 'unknown'),
+            })
+        elif name == 'subscription':
+            subscription = {'id': attributes.get('id', 'unknown')}
+            for key in ['disabledFilters', 'version', 'lastDownloadAttempt',
+                        'lastDownloadSuccess', 'softExpiration',
+                        'hardExpiration', 'downloadStatus']:
+                subscription[key] = attributes.get(key, 'unknown')
+            data['subscriptions'].append(subscription)
+        elif name == 'extension':
+            data['extensions'].append({
+                key: attributes.get(key, 'unknown')
+                for key in ['id', 'name', 'version', 'type']
+            })
+        elif name == 'error':
+            error = {
+                key: attributes.get(key, 'unknown')
+                for key in ['type', 'text', 'file', 'line', 'column']
+            }
+            error['sourceLine'] = re.sub(r'[\r\n]+$', '',
+                                         attributes.get('sourceLine', ''))
+            data['errors'].append(error)
+        elif name == 'screenshot':
+            data['screenshotEdited'] = attributes.get('edited') == 'true'
+
+        self._tag_stack.append((name, attributes))
+
+    def _end_element(self, name):
+        self._flush_element()
+        self._tag_stack.pop()
+
+    def _flush_element(self):
+        if self._element is not None:
+            name, attributes, text = self._element
+            self._element = None
+            self.known_issues.element(
+                name,
+                {key: value.strip() for key, value in attributes.iteritems()},
+                ''.join(text).strip(),
+            )
+
+    def _text(self, text):
+        element = self._element
+        if element is not None and element[0] in self.known_issues.textTags:
+            element[2].append(text)
+
+        if not self._tag_stack:
+            return
+
+        name, attributes = self._tag_stack[-1]
+        if name == 'option':
+            option = attributes.get('id')
+            if option in OPTIONS:
+                self.data[OPTIONS[option]] = text == 'true'
+            elif option == 'cookieBehavior':
+                try:
+                    self.data['option_cookieBehavior'] = int(text)
+                except ValueError:
+                    pass
+        elif name in TEXT_FIELDS:
+            self.data[name] = self.data.get(name, '') + text
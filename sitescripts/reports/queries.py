@@ -0,0 +1,51 @@
+# This file is part of the Adblock Plus web scripts,
+# Copyright (C) 2006-present eyeo GmbH
+#
+# Adblock Plus is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 3 as
+# published by the Free Software Foundation.
+#
+# Adblock Plus is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Adblock Plus.  If not, see <http://www.gnu.org/licenses/>.
+
+"""SQL queries for the reports database."""
+
+REPORT_COLUMNS = ('guid', 'type', 'UNIX_TIMESTAMP(ctime) AS ctime', 'status',
+                  'site', 'contact', 'comment', 'hasscreenshot', 'knownissues')
+
+
+def reports_page_query(condition, args, columns, batch_size, last_key=None):
+    """Return the query and arguments selecting a page of reports.
+
+    Pages are selected by the (ctime, guid) position of the last row of the
+    previous page rather than an offset, so that MySQL can seek to the next
+    page on the ctime index instead of scanning all preceding rows again.
+    Each row starts with the columns pageCtime and pageGuid holding that
+    position.
+
+    The key columns are always qualified with the table name. The columns
+    may define aliases shadowing them (like `UNIX_TIMESTAMP(ctime) AS
+    ctime`), and MySQL would resolve unqualified names in ORDER BY to such
+    an alias, which can't be sorted by using the index.
+    """
+    conditions = ['(%s)' % condition] if condition else []
+    params = list(args)
+    if last_key is not None:
+        conditions.append('(#PFX#reports.ctime > %s OR '
+                          '(#PFX#reports.ctime = %s AND '
+                          '#PFX#reports.guid > %s))')
+        params.extend((last_key[0], last_key[0], last_key[1]))
+
+    query = ('SELECT #PFX#reports.ctime AS pageCtime, '
+             '#PFX#reports.guid AS pageGuid, %s FROM #PFX#reports' %
+             ', '.join(columns))
+    if conditions:
+        query += ' WHERE ' + ' AND '.join(conditions)
+    query += ' ORDER BY #PFX#reports.ctime, #PFX#reports.guid LIMIT %s'
+    params.append(batch_size)
+    return query, params
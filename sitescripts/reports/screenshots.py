@@ -0,0 +1,169 @@
+# This file is part of the Adblock Plus web scripts,
+# Copyright (C) 2006-present eyeo GmbH
+#
+# Adblock Plus is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 3 as
+# published by the Free Software Foundation.
+#
+# Adblock Plus is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Adblock Plus.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Content-addressed storage and optimization of report screenshots.
+
+Each distinct screenshot is stored once under `screenshots/` in the data
+directory, named after the SHA-1 hash of the submitted image. The
+screenshot path of each report is a hard link to that file, so the link
+count tells whether any report still refers to it.
+"""
+
+import errno
+import hashlib
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import uuid
+from multiprocessing.pool import ThreadPool
+
+SCREENSHOT_DIR = 'screenshots'
+OPTIMIZED_SUFFIX = '.optimized'
+TEMP_PREFIX = '.tmp'
+STORE_ATTEMPTS = 3
+
+
+def get_screenshot_path(data_path, digest):
+    """Return the path of the stored screenshot with the given hash."""
+    return os.path.join(data_path, SCREENSHOT_DIR, digest[:2], digest[2:4],
+                        digest + '.png')
+
+
+def _ensure_dir(path):
+    dir = os.path.dirname(path)
+    if not os.path.isdir(dir):
+        try:
+            os.makedirs(dir)
+        except OSError:
+            # Another process might have created it in the meantime
+            if not os.path.isdir(dir):
+                raise
+
+
+def _write_stored(stored_path, data):
+    handle, temp_path = tempfile.mkstemp(prefix=TEMP_PREFIX,
+                                         dir=os.path.dirname(stored_path))
+    with os.fdopen(handle, 'wb') as file:
+        file.write(data)
+    os.chmod(temp_path, 0o644)
+    os.rename(temp_path, stored_path)
+
+
+def store_screenshot(data_path, path, data):
+    """Store the PNG image `data` and make `path` a link to it.
+
+    Returns the hash that the screenshot is stored under.
+    """
+    digest = hashlib.sha1(data).hexdigest()
+    stored_path = get_screenshot_path(data_path, digest)
+    _ensure_dir(stored_path)
+    _ensure_dir(path)
+
+    # Link under a temporary name first, so that an existing screenshot of
+    # the report is replaced atomically.
+    temp_path = os.path.join(os.path.dirname(path),
+                             TEMP_PREFIX + uuid.uuid4().hex)
+    for attempt in range(STORE_ATTEMPTS):
+        if not os.path.exists(stored_path):
+            _write_stored(stored_path, data)
+        try:
+            os.link(stored_path, temp_path)
+            break
+        except OSError as error:
+            # remove_unreferenced() might have deleted the stored file
+            # before it got linked, in which case it is written again.
+            if error.errno != errno.ENOENT or attempt == STORE_ATTEMPTS - 1:
+                raise
+    os.rename(temp_path, path)
+    return digest
+
+
+def _is_screenshot(name):
+    return name.endswith('.png') and not name.startswith(TEMP_PREFIX)
+
+
+def find_unoptimized(data_path):
+    """Yield the paths of the stored screenshots not optimized yet."""
+    for dir, dirs, files in os.walk(os.path.join(data_path, SCREENSHOT_DIR)):
+        names = set(files)
+        for name in files:
+            if _is_screenshot(name) and name + OPTIMIZED_SUFFIX not in names:
+                yield os.path.join(dir, name)
+
+
+def optimize_screenshot(path, command):
+    """Run the PNG optimizer `command` on a stored screenshot.
+
+    The optimizer runs on a copy. If it makes the image smaller, the result
+    is written back into the stored file itself, which keeps the links of
+    the reports intact.
+    """
+    handle, temp_path = tempfile.mkstemp(prefix=TEMP_PREFIX,
+                                         dir=os.path.dirname(path))
+    os.close(handle)
+    try:
+        shutil.copyfile(path, temp_path)
+        subprocess.check_call(command + [temp_path])
+        if os.path.getsize(temp_path) < os.path.getsize(path):
+            with open(temp_path, 'rb') as source, open(path, 'r+b') as target:
+                shutil.copyfileobj(source, target)
+                target.truncate()
+    finally:
+        os.remove(temp_path)
+    open(path + OPTIMIZED_SUFFIX, 'wb').close()
+
+
+def _optimize(args):
+    path, command = args
+    try:
+        optimize_screenshot(path, command)
+        return True
+    except (OSError, IOError, subprocess.CalledProcessError) as error:
+        print >>sys.stderr, 'Failed to optimize %s: %s' % (path, error)
+        return False
+
+
+def optimize_screenshots(data_path, command, workers=2):
+    """Optimize all stored screenshots that haven't been optimized yet.
+
+    At most `workers` optimizer processes run at the same time. Returns the
+    number of screenshots that were optimized.
+    """
+    pool = ThreadPool(workers)
+    try:
+        tasks = ((path, command) for path in find_unoptimized(data_path))
+        return sum(pool.imap_unordered(_optimize, tasks))
+    finally:
+        pool.close()
+        pool.join()
+
+
+def remove_unreferenced(data_path):
+    """Remove the stored screenshots that no report links to anymore.
+
+    Returns the number of screenshots removed.
+    """
+    removed = 0
+    for dir, dirs, files in os.walk(os.path.join(data_path, SCREENSHOT_DIR)):
+        for name in files:
+            path = os.path.join(dir, name)
+            if _is_screenshot(name) and os.stat(path).st_nlink == 1:
+                os.remove(path)
+                if os.path.exists(path + OPTIMIZED_SUFFIX):
+                    os.remove(path + OPTIMIZED_SUFFIX)
+                removed += 1
+    return removed
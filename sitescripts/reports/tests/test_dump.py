@@ -0,0 +1,48 @@
+# This file is part of the Adblock Plus web scripts,
+# Copyright (C) 2006-present eyeo GmbH
+#
+# Adblock Plus is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 3 as
+# published by the Free Software Foundation.
+#
+# Adblock Plus is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Adblock Plus.  If not, see <http://www.gnu.org/licenses/>.
+
+import marshal
+
+import pytest
+
+from sitescripts.reports.dump import encode_report, decode_report, is_current
+
+REPORT = {
+    'type': 'false positive',
+    'comment': u'Caf\xe9',
+    'time': 1500000000.5,
+    'requests': [{'location': 'https://example.com/ad.js', 'count': 3}] * 100,
+    'warnings': {},
+}
+
+
+def test_roundtrip():
+    dump = encode_report(REPORT)
+
+    assert is_current(dump)
+    assert decode_report(dump) == REPORT
+    assert len(dump) < len(marshal.dumps(REPORT))
+
+
+def test_legacy_dump():
+    dump = marshal.dumps(REPORT)
+
+    assert not is_current(dump)
+    assert decode_report(dump) == REPORT
+
+
+def test_unknown_format():
+    with pytest.raises(ValueError):
+        decode_report('\x7fgarbage')
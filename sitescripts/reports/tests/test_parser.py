@@ -0,0 +1,138 @@
+# This file is part of the Adblock Plus web scripts,
+# Copyright (C) 2006-present eyeo GmbH
+#
+# Adblock Plus is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 3 as
+# published by the Free Software Foundation.
+#
+# Adblock Plus is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Adblock Plus.  If not, see <http://www.gnu.org/licenses/>.
+
+from StringIO import StringIO
+
+from sitescripts.reports.parser import (
+    ReportParser, LENGTH_RESTRICTIONS, save_known_issues, load_known_issues,
+)
+from sitescripts.subscriptions.knownIssuesParser import (
+    Matcher, parseRules, iterLineElements,
+)
+
+KNOWN_ISSUES = [
+    '[Ads]',
+    'mainURL = ||example.com^',
+    'requestLocation = ads.example.com',
+    'url = https://example.com/ads?lang=%LANG%',
+    '[Enabled]',
+    'isEnabled = true',
+    'filterText = ads.example.com^',
+    'url = https://example.com/enabled',
+    '[Disabled]',
+    'isEnabled = false',
+    'url = https://example.com/disabled',
+    '[Other site]',
+    'mainURL = other.example',
+    'url = https://example.com/other',
+]
+
+REPORT = '''<?xml version="1.0"?>
+<report type="false positive">
+  <adblock-plus version="99.9" locale="en-US"/>
+  <application name="Firefox" vendor="Mozilla" version="60.0"/>
+  <window url="https://example.com/page"/>
+  <request location="https://ads.example.com/ad.js" type="SCRIPT" count="3"/>
+  <filter text="||ads.example.com^" subscriptions="~fl~ https://e.com/l.txt"/>
+  <subscription id="https://e.com/l.txt" version="201801010000"/>
+  <option id="enabled">true</option>
+  <option id="cookieBehavior">2</option>
+  <comment>Hello </comment>
+  <email>user@example.com</email>
+  <screenshot edited="true">nonsense</screenshot>
+</report>
+'''
+
+
+def parse(xml):
+    parser = ReportParser()
+    parser.parse(StringIO(xml))
+    return parser
+
+
+def test_parse_report():
+    data = parse(REPORT).data
+
+    assert data['type'] == 'false positive'
+    assert data['abp_version'] == 'development environment'
+    assert data['siteName'] == 'example.com'
+    assert data['requests'][0]['count'] == 3
+    assert data['filters'][0]['subscriptions'] == [
+        'My Ad Blocking Rules', 'https://e.com/l.txt',
+    ]
+    assert data['subscriptions'][0]['version'] == '201801010000'
+    assert data['subscriptions'][0]['downloadStatus'] == 'unknown'
+    assert data['option_enabled'] is True
+    assert data['option_cookieBehavior'] == 2
+    assert data['comment'] == 'Hello '
+    assert data['email'] == 'user@example.com'
+    assert data['screenshotEdited'] is True
+    assert 'screenshot' not in data
+    assert data['warnings'] == {}
+
+
+def test_parsing_error():
+    data = parse('<report><comment>unclosed</report>').data
+
+    assert data['comment'] == 'unclosed'
+    assert data['warnings']['!parsing'].startswith('Parsing error')
+
+
+def test_parsers_are_independent():
+    first = ReportParser()
+    second = ReportParser()
+    first.parse(StringIO('<report type="first"><comment>a</comment></report>'))
+    second.parse(StringIO('<report><comment>b</comment></report>'))
+
+    assert first.data['type'] == 'first'
+    assert first.data['comment'] == 'a'
+    assert second.data['type'] == 'unknown'
+    assert second.data['comment'] == 'b'
+
+
+def test_validate_truncates():
+    parser = parse(REPORT)
+    parser.data['abp_locale'] = 'x' * 100
+    parser.data['requests'] *= LENGTH_RESTRICTIONS['default_list'] + 1
+    data = parser.validate()
+
+    assert data['abp_locale'] == 'x' * 32 + u'\u2026'
+    assert len(data['requests']) == LENGTH_RESTRICTIONS['default_list']
+    assert set(data['warnings']) == {'abp_locale', 'requests'}
+
+
+def test_known_issues():
+    matcher = Matcher(*parseRules(KNOWN_ISSUES))
+    parser = ReportParser(matcher.start())
+    parser.parse(StringIO(REPORT))
+
+    expected = [
+        'https://example.com/ads?lang=%LANG%',
+        'https://example.com/enabled',
+    ]
+    assert parser.known_issues.urls() == expected
+    assert matcher.match(iterLineElements(REPORT.splitlines()), '%LANG%') == \
+        expected
+    assert parser.known_issues.result('de')[0] == \
+        'https://example.com/ads?lang=de'
+
+
+def test_store_known_issues(tmpdir):
+    path = tmpdir.join('report.xml').strpath
+
+    assert load_known_issues(path) is None
+    save_known_issues(path, ['https://example.com/%LANG%'])
+    assert load_known_issues(path) == ['https://example.com/%LANG%']
+    assert tmpdir.join('report.knownIssues.json').check()
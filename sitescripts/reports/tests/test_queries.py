@@ -0,0 +1,55 @@
+# This file is part of the Adblock Plus web scripts,
+# Copyright (C) 2006-present eyeo GmbH
+#
+# Adblock Plus is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 3 as
+# published by the Free Software Foundation.
+#
+# Adblock Plus is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Adblock Plus.  If not, see <http://www.gnu.org/licenses/>.
+
+import re
+
+from sitescripts.reports.queries import REPORT_COLUMNS, reports_page_query
+
+
+def order_by(query):
+    clause = re.search(r' ORDER BY (.*?) LIMIT ', query).group(1)
+    return [term.strip() for term in clause.split(',')]
+
+
+def aliases(query):
+    return set(re.findall(r' AS (\w+)', query))
+
+
+def test_first_page():
+    query, params = reports_page_query('ctime >= FROM_UNIXTIME(%s)', (123,),
+                                       REPORT_COLUMNS, 100)
+
+    assert ' WHERE (ctime >= FROM_UNIXTIME(%s)) ORDER BY ' in query
+    assert params == [123, 100]
+
+
+def test_next_page():
+    query, params = reports_page_query(None, (), ['guid'], 100,
+                                       ('2018-01-01 00:00:00', 'abc'))
+
+    assert ' WHERE (#PFX#reports.ctime > %s OR ' in query
+    assert params == ['2018-01-01 00:00:00', '2018-01-01 00:00:00', 'abc',
+                      100]
+
+
+def test_order_not_shadowed_by_aliases():
+    # MySQL resolves ORDER BY names to select aliases first, sorting by
+    # UNIX_TIMESTAMP(ctime) rather than the indexed ctime column.
+    query, params = reports_page_query(None, (), REPORT_COLUMNS, 100,
+                                       ('2018-01-01 00:00:00', 'abc'))
+
+    assert 'ctime' in aliases(query)
+    assert order_by(query) == ['#PFX#reports.ctime', '#PFX#reports.guid']
+    assert not aliases(query) & set(order_by(query))
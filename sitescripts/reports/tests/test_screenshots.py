@@ -0,0 +1,106 @@
+# This file is part of the Adblock Plus web scripts,
+# Copyright (C) 2006-present eyeo GmbH
+#
+# Adblock Plus is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 3 as
+# published by the Free Software Foundation.
+#
+# Adblock Plus is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Adblock Plus.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import sys
+
+from sitescripts.reports.screenshots import (
+    store_screenshot, get_screenshot_path, find_unoptimized,
+    optimize_screenshots, remove_unreferenced,
+)
+
+SHRINK = [sys.executable, '-c',
+          'import sys; open(sys.argv[1], "wb").write("small")']
+
+
+def store(tmpdir, guid, data):
+    path = tmpdir.join(guid[0], guid + '.png').strpath
+    return path, store_screenshot(tmpdir.strpath, path, data)
+
+
+def test_duplicates_stored_once(tmpdir):
+    first, digest = store(tmpdir, 'abc', 'image data')
+    second, other_digest = store(tmpdir, 'def', 'image data')
+    stored = get_screenshot_path(tmpdir.strpath, digest)
+
+    assert digest == other_digest
+    assert os.path.samefile(first, stored)
+    assert os.path.samefile(second, stored)
+    assert os.stat(stored).st_nlink == 3
+
+
+def test_stored_screenshot_removed_concurrently(tmpdir, mocker):
+    existing, digest = store(tmpdir, 'abc', 'image data')
+    os.remove(existing)
+    link = os.link
+    calls = []
+
+    def link_after_cleanup(source, target):
+        # The first attempt races with removeOldReports
+        if not calls:
+            remove_unreferenced(tmpdir.strpath)
+        calls.append(target)
+        return link(source, target)
+
+    mocker.patch('os.link', side_effect=link_after_cleanup)
+    path, digest = store(tmpdir, 'def', 'image data')
+
+    assert open(path, 'rb').read() == 'image data'
+    assert os.path.samefile(path, get_screenshot_path(tmpdir.strpath, digest))
+    assert os.listdir(os.path.dirname(path)) == ['def.png']
+    assert len(calls) == 2
+
+
+def test_replace_screenshot(tmpdir):
+    path, digest = store(tmpdir, 'abc', 'old image')
+    path, new_digest = store(tmpdir, 'abc', 'new image')
+
+    assert digest != new_digest
+    assert open(path, 'rb').read() == 'new image'
+    assert remove_unreferenced(tmpdir.strpath) == 1
+    assert not os.path.exists(get_screenshot_path(tmpdir.strpath, digest))
+
+
+def test_optimize_screenshots(tmpdir):
+    first, digest = store(tmpdir, 'abc', 'large image data')
+    second, digest = store(tmpdir, 'def', 'large image data')
+    stored = get_screenshot_path(tmpdir.strpath, digest)
+
+    assert list(find_unoptimized(tmpdir.strpath)) == [stored]
+    assert optimize_screenshots(tmpdir.strpath, SHRINK) == 1
+    assert list(find_unoptimized(tmpdir.strpath)) == []
+    assert open(first, 'rb').read() == 'small'
+    assert open(second, 'rb').read() == 'small'
+    assert optimize_screenshots(tmpdir.strpath, SHRINK) == 0
+
+
+def test_failed_optimization_is_retried(tmpdir):
+    path, digest = store(tmpdir, 'abc', 'image data')
+
+    assert optimize_screenshots(tmpdir.strpath, ['false']) == 0
+    assert open(path, 'rb').read() == 'image data'
+    assert len(list(find_unoptimized(tmpdir.strpath))) == 1
+
+
+def test_remove_unreferenced(tmpdir):
+    path, digest = store(tmpdir, 'abc', 'image data')
+    optimize_screenshots(tmpdir.strpath, SHRINK)
+
+    assert remove_unreferenced(tmpdir.strpath) == 0
+    os.remove(path)
+    assert remove_unreferenced(tmpdir.strpath) == 1
+    assert os.listdir(os.path.dirname(
+        get_screenshot_path(tmpdir.strpath, digest),
+    )) == []
@@ -17,11 +17,13 @@ import hashlib
 import hmac
 import base64
 import MySQLdb
+import errno
 import os
 import re
-import marshal
-import subprocess
-from sitescripts.utils import get_config, cached, get_template, anonymizeMail, sendMail
+from sitescripts.utils import get_config, cached, get_template, anonymizeMail, sendMail, sendMails
+from sitescripts.reports.dump import encode_report, decode_report
+from sitescripts.reports.queries import REPORT_COLUMNS, reports_page_query
+from sitescripts.reports.screenshots import store_screenshot
 
 
 def getReportSubscriptions(guid):
@@ -36,23 +38,65 @@ def getReportSubscriptions(guid):
     return rows
 
 
-def getReports(startTime):
-    count = 10000
-    offset = 0
+def getDigestReports(startTime):
+    # Loads everything the digests need for the reports since startTime with
+    # a fixed number of queries, rather than querying the subscriptions and
+    # the contact's score for each report separately.
+    reports = list(getReports(startTime))
+
+    cursor = get_db().cursor()
+    sublists = {}
+    executeQuery(cursor,
+                 '''SELECT report, url, hasmatches FROM #PFX#sublists
+              INNER JOIN #PFX#subscriptions ON (#PFX#sublists.list = #PFX#subscriptions.id)
+              INNER JOIN #PFX#reports ON (#PFX#sublists.report = #PFX#reports.guid)
+              WHERE ctime >= FROM_UNIXTIME(%s)''',
+                 startTime)
+    for guid, url, hasmatches in cursor:
+        sublists.setdefault(guid, []).append({'url': url, 'hasmatches': hasmatches})
+
+    scores = {}
+    executeQuery(cursor,
+                 '''SELECT id, %s FROM #PFX#users WHERE id IN
+              (SELECT contact FROM #PFX#reports WHERE ctime >= FROM_UNIXTIME(%%s))''' % USEFULNESS_SCORE,
+                 startTime)
+    for contact, score in cursor:
+        scores[contact] = convertUsefulnessScore(score)
+    cursor.close()
+
+    for report in reports:
+        report['sublists'] = sublists.get(report['guid'], [])
+        report['score'] = scores.get(report['contact'], 0)
+    return reports
+
+
+def iterReports(condition=None, args=(), columns=REPORT_COLUMNS, batchSize=10000):
+    cursor = get_db().cursor(MySQLdb.cursors.DictCursor)
+    lastKey = None
     while True:
-        cursor = get_db().cursor(MySQLdb.cursors.DictCursor)
-        executeQuery(cursor,
-                     '''SELECT guid, type, UNIX_TIMESTAMP(ctime) AS ctime, status, site, contact,
-                comment, hasscreenshot, knownissues
-                FROM #PFX#reports WHERE ctime >= FROM_UNIXTIME(%s) LIMIT %s OFFSET %s''',
-                     (startTime, count, offset))
+        query, params = reports_page_query(condition, args, columns, batchSize, lastKey)
+        executeQuery(cursor, query, params)
         rows = cursor.fetchall()
-        cursor.close()
-        if len(rows) == 0:
-            break
         for row in rows:
+            lastKey = (row.pop('pageCtime'), row.pop('pageGuid'))
             yield row
-        offset += len(rows)
+        if len(rows) < batchSize:
+            break
+    cursor.close()
+
+
+def getReports(startTime, batchSize=10000):
+    return iterReports('ctime >= FROM_UNIXTIME(%s)', (startTime,), batchSize=batchSize)
+
+
+@cached(600)
+def getSubscriptionIds():
+    cursor = get_db().cursor()
+    executeQuery(cursor, 'SELECT url, id FROM #PFX#subscriptions')
+    # Keys are lowercase to match URLs case-insensitively like MySQL does
+    result = {url.lower(): id for url, id in cursor.fetchall()}
+    cursor.close()
+    return result
 
 
 def getReportsForUser(contact):
@@ -74,7 +118,7 @@ def getReport(guid):
     if report == None:
         return None
 
-    reportData = marshal.loads(report[0])
+    reportData = decode_report(report[0])
     return reportData
 
 
@@ -90,7 +134,7 @@ def saveReport(guid, reportData, isNew=False):
         del reportData['screenshot']
     knownIssues = len(reportData.get('knownIssues', []))
     contact = getUserId(reportData.get('email', None)) if reportData.get('email', None) else None
-    dumpstr = marshal.dumps(reportData)
+    dumpstr = encode_report(reportData)
 
     if contact != None and isNew:
         executeQuery(cursor, 'INSERT INTO #PFX#users (id, reports) VALUES (%s, 1) ON DUPLICATE KEY UPDATE reports = reports + 1', contact)
@@ -103,15 +147,18 @@ def saveReport(guid, reportData, isNew=False):
                  {'guid': guid, 'type': reportData.get('type', None), 'ctime': reportData['time'], 'site': reportData.get('siteName', None),
                   'comment': reportData.get('comment', None), 'status': reportData.get('status', None), 'contact': contact,
                   'hasscreenshot': reportData.get('hasscreenshot', 0), 'knownissues': knownIssues, 'dump': dumpstr})
-    if len(reportData['subscriptions']) > 0:
-        for sn in reportData['subscriptions']:
-            executeQuery(cursor, 'SELECT id FROM #PFX#subscriptions WHERE url = %s', sn['id'])
-            id = cursor.fetchone()
-            if id != None:
-                def filterMatch(f):
-                    return any(u == sn['id'] for u in f.get('subscriptions', []))
-                hasMatches = any(filterMatch(f) for f in reportData.get('filters', []))
-                executeQuery(cursor, 'INSERT IGNORE INTO #PFX#sublists (report, list, hasmatches) VALUES (%s, %s, %s)', (guid, id[0], hasMatches))
+    subscriptionIds = getSubscriptionIds()
+    matchedUrls = {url for f in reportData.get('filters', []) for url in f.get('subscriptions', [])}
+    sublists = []
+    for sn in reportData['subscriptions']:
+        id = subscriptionIds.get(sn['id'].lower())
+        if id != None:
+            sublists.extend((guid, id, sn['id'] in matchedUrls))
+    if len(sublists) > 0:
+        executeQuery(cursor,
+                     'INSERT IGNORE INTO #PFX#sublists (report, list, hasmatches) VALUES ' +
+                     ', '.join(['(%s, %s, %s)'] * (len(sublists) // 3)),
+                     sublists)
 
     get_db().commit()
 
@@ -140,12 +187,26 @@ def removeReport(guid):
     cursor = get_db().cursor()
     executeQuery(cursor, 'DELETE FROM #PFX#reports WHERE guid = %s', guid)
     get_db().commit()
-    file = os.path.join(get_config().get('reports', 'dataPath'), guid[0], guid[1], guid[2], guid[3], guid + '.html')
-    if os.path.isfile(file):
-        os.remove(file)
-    file = os.path.join(get_config().get('reports', 'dataPath'), guid[0], guid[1], guid[2], guid[3], guid + '.png')
-    if os.path.isfile(file):
-        os.remove(file)
+    removeReportFiles(guid)
+
+
+def removeReports(guids):
+    placeholders = ', '.join(['%s'] * len(guids))
+    cursor = get_db().cursor()
+    executeQuery(cursor, 'DELETE FROM #PFX#sublists WHERE report IN (%s)' % placeholders, guids)
+    executeQuery(cursor, 'DELETE FROM #PFX#reports WHERE guid IN (%s)' % placeholders, guids)
+    get_db().commit()
+    cursor.close()
+
+
+def removeReportFiles(guid):
+    dir = os.path.join(get_config().get('reports', 'dataPath'), guid[0], guid[1], guid[2], guid[3])
+    for file in [guid + '.html', guid + '.png']:
+        try:
+            os.remove(os.path.join(dir, file))
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
 
 
 def getUser(contact):
@@ -155,26 +216,31 @@ def getUser(contact):
     return user
 
 
+# source from http://www.evanmiller.org/how-not-to-sort-by-average-rating.html
+USEFULNESS_SCORE = '''((positive + 1.9208) / (positive + negative)
+        - 1.96 * SQRT((positive * negative) / (positive + negative) + 0.9604) / (positive + negative))
+        / (1 + 3.8416 / (positive + negative))'''
+
+
+def convertUsefulnessScore(score):
+    if score == None:  # no score yet
+        return 0.3
+    else:
+        return 4 * score
+
+
 @cached(3600)
 def getUserUsefulnessScore(contact):
     if contact == None:
         return 0
 
     cursor = get_db().cursor()
-    # source from http://www.evanmiller.org/how-not-to-sort-by-average-rating.html
-    executeQuery(cursor,
-                 '''SELECT ((positive + 1.9208) / (positive + negative)
-                        - 1.96 * SQRT((positive * negative) / (positive + negative) + 0.9604) / (positive + negative))
-                        / (1 + 3.8416 / (positive + negative)) AS score FROM #PFX#users WHERE id = %s''',
-                 contact)
+    executeQuery(cursor, 'SELECT %s AS score FROM #PFX#users WHERE id = %%s' % USEFULNESS_SCORE, contact)
     score = cursor.fetchone()
     if score == None:
         return 0
 
-    if score[0] == None:  # no score yet
-        return 0.3
-    else:
-        return 4 * score[0]
+    return convertUsefulnessScore(score[0])
 
 
 def updateUserUsefulness(contact, newusefulness, oldusefulness):
@@ -202,23 +268,20 @@ def saveScreenshot(guid, screenshot):
     if not screenshot.startswith(prefix):
         raise TypeError('Screenshot is not a PNG image')
     data = base64.b64decode(screenshot[len(prefix):])
-    file = os.path.join(get_config().get('reports', 'dataPath'), guid[0], guid[1], guid[2], guid[3], guid + '.png')
-    dir = os.path.dirname(file)
-    if not os.path.exists(dir):
-        os.makedirs(dir)
-    f = open(file, 'wb')
-    f.write(data)
-    f.close()
-    if get_config().has_option('reports', 'pngOptimizerPath'):
-        cmd = get_config().get('reports', 'pngOptimizerPath').split()
-        cmd.append(file)
-        subprocess.call(cmd)
+    dataPath = get_config().get('reports', 'dataPath')
+    file = os.path.join(dataPath, guid[0], guid[1], guid[2], guid[3], guid + '.png')
+    # Optimization is left to processReports, which runs in the background
+    store_screenshot(dataPath, file, data)
 
 
 def mailDigest(templateData):
     sendMail(get_config().get('reports', 'mailDigestTemplate'), templateData)
 
 
+def mailDigests(templateDataList):
+    sendMails(get_config().get('reports', 'mailDigestTemplate'), templateDataList)
+
+
 def sendUpdateNotification(templateData):
     sendMail(get_config().get('reports', 'notificationTemplate'), templateData)
 
@@ -16,9 +16,11 @@
 import re
 import os
 import sys
+from StringIO import StringIO
 from urlparse import parse_qs
 from sitescripts.utils import get_config, get_template
 from sitescripts.web import url_handler
+from sitescripts.reports.parser import ReportParser, save_known_issues, known_issues_path
 import sitescripts.subscriptions.knownIssuesParser as knownIssuesParser
 
 
@@ -59,12 +61,20 @@ def handleRequest(environ, start_response):
         file.write(data)
         file.close()
 
-        knownIssues = knownIssuesParser.findMatches(data.splitlines(), params.get('lang', ['en-US'])[0])
+        parser = ReportParser(knownIssuesParser.getMatcher().start())
+        parser.parse(StringIO(data))
+        knownIssues = parser.known_issues.urls()
+        # Stored before the report appears, so that parseNewReports never
+        # has to match the known issues of this report again.
+        save_known_issues(path, knownIssues)
+        knownIssues = knownIssuesParser.localizeURLs(knownIssues, params.get('lang', ['en-US'])[0])
 
         os.rename(path + '.tmp', path)
     except Exception as e:
         if os.path.isfile(path + '.tmp'):
             os.remove(path + '.tmp')
+        if os.path.isfile(known_issues_path(path)):
+            os.remove(known_issues_path(path))
         raise e
 
     template = get_template(get_config().get('reports', 'submitResponseTemplate'))
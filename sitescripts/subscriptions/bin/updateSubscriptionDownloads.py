@@ -15,13 +15,16 @@
 
 import os
 import re
+import json
+import logging
 import subprocess
 import tempfile
 import shutil
 import zipfile
 from StringIO import StringIO
 from ...utils import get_config, setupStderr
-from ..combineSubscriptions import combine_subscriptions
+from ..combineSubscriptions import (combine_subscriptions, FileSource,
+                                    remote_includes_changed)
 
 
 class MercurialSource:
@@ -46,18 +49,103 @@ class MercurialSource:
                 yield filename
 
 
-if __name__ == '__main__':
-    setupStderr()
+class MercurialSnapshotSource(FileSource):
+    """Source reading from a snapshot of the repository's default revision.
+
+    The snapshot is extracted into `cache_dir` and reused for as long as that
+    revision doesn't change.
+    """
+
+    def __init__(self, repo, cache_dir):
+        command = ['hg', '-R', repo, 'log', '-r', 'default',
+                   '--template', '{node}']
+        self.revision = subprocess.check_output(command).strip()
+
+        path = os.path.join(cache_dir, self.revision)
+        if not os.path.isdir(path):
+            if not os.path.exists(cache_dir):
+                os.makedirs(cache_dir)
+            temp_path = tempfile.mkdtemp(dir=cache_dir, prefix='.')
+            try:
+                subprocess.check_call(['hg', '-R', repo, 'archive',
+                                       '--config', 'ui.archivemeta=false',
+                                       '-r', self.revision, '-t', 'files',
+                                       temp_path])
+                os.rename(temp_path, path)
+            finally:
+                shutil.rmtree(temp_path, ignore_errors=True)
+
+        for name in os.listdir(cache_dir):
+            if name != self.revision:
+                shutil.rmtree(os.path.join(cache_dir, name),
+                              ignore_errors=True)
+
+        FileSource.__init__(self, path)
+
+    def close(self):
+        pass
 
-    source_repos = {}
-    for option, value in get_config().items('subscriptionDownloads'):
+
+def update_subscription_downloads():
+    config = get_config()
+    section = 'subscriptionDownloads'
+    repos = {}
+    for option, value in config.items(section):
         if option.endswith('_repository'):
-            source_repos[re.sub(r'_repository$', '', option)] = MercurialSource(value)
+            repos[re.sub(r'_repository$', '', option)] = value
 
-    basedir = get_config().get('subscriptionDownloads', 'outdir')
+    basedir = config.get(section, 'outdir')
     destination = os.path.join(basedir, 'data')
+    diff_versions = 0
+    if config.has_option(section, 'diff_versions'):
+        diff_versions = config.getint(section, 'diff_versions')
+    optimize = (config.has_option(section, 'optimize') and
+                config.getboolean(section, 'optimize'))
+    if optimize:
+        # Report the filters removed from each list
+        logging.basicConfig(level=logging.INFO, format='%(message)s')
+
+    if not config.has_option(section, 'cachedir'):
+        sources = {name: MercurialSource(repo)
+                   for name, repo in repos.iteritems()}
+        try:
+            combine_subscriptions(sources, destination, tempdir=basedir,
+                                  diff_versions=diff_versions,
+                                  optimize=optimize)
+        finally:
+            for source in sources.itervalues():
+                source.close()
+        return
+
+    # Only combine the subscriptions if any of the repositories or any of the
+    # remote includes changed since the last successful run.
+    cache_dir = config.get(section, 'cachedir')
+    sources = {name: MercurialSnapshotSource(repo,
+                                             os.path.join(cache_dir, name))
+               for name, repo in repos.iteritems()}
+    revisions = {name: source.revision
+                 for name, source in sources.iteritems()}
+    revisions_path = os.path.join(cache_dir, 'revisions.json')
     try:
-        combine_subscriptions(source_repos, destination, tempdir=basedir)
-    finally:
-        for source in source_repos.itervalues():
-            source.close()
+        with open(revisions_path, 'rb') as handle:
+            previous_revisions = json.load(handle)
+    except (IOError, ValueError):
+        previous_revisions = None
+
+    if revisions == previous_revisions and os.path.isdir(destination):
+        if not remote_includes_changed(destination):
+            return
+
+    if os.path.exists(revisions_path):
+        os.remove(revisions_path)
+    failed = combine_subscriptions(sources, destination, tempdir=basedir,
+                                   diff_versions=diff_versions,
+                                   optimize=optimize)
+    if not failed:
+        with open(revisions_path, 'wb') as handle:
+            json.dump(revisions, handle)
+
+
+if __name__ == '__main__':
+    setupStderr()
+    update_subscription_downloads()
@@ -26,20 +26,67 @@ import codecs
 import hashlib
 import base64
 import tempfile
+import shutil
+import json
+import logging
+import difflib
+import itertools
 from getopt import getopt, GetoptError
 
 accepted_extensions = set(['.txt'])
 ignore = set(['Apache.txt', 'CC-BY-SA.txt', 'GPL.txt', 'MPL.txt'])
 verbatim = set(['COPYING'])
-
-
-def combine_subscriptions(sources, target_dir, timeout=30, tempdir=None):
+fingerprints_file = '.fingerprints.json'
+history_dir = '.history'
+diff_dir = 'diff'
+
+header_regex = re.compile(r'\[Adblock(?:\s*Plus\s*([\d\.]+)?)?\]', re.I)
+include_regex = re.compile(r'^\s*%include\s+(.*)%\s*$')
+special_comment_regex = re.compile(r'^\s*!\s*(Redirect|Homepage|Title|Checksum|Version|Expires)\s*:', re.M | re.I)
+remote_special_comment_regex = re.compile(r'^\s*!\s*(Redirect|Homepage|Title|Version|Expires)\s*:', re.M | re.I)
+comment_regex = re.compile(r'^\s*!')
+
+# Options that only ever restrict the requests a filter applies to, a filter
+# with these options is redundant if the same filter without options exists.
+restricting_options = frozenset([
+    'other', 'script', 'image', 'stylesheet', 'object', 'subdocument',
+    'xmlhttprequest', 'websocket', 'webrtc', 'ping', 'media', 'font',
+    'object-subrequest', 'third-party', 'match-case', 'domain',
+])
+
+tpl_expires_regex = re.compile(r'^\s*!\s*Expires\s*:\s*(\d+)\s*(h)?', re.I)
+tpl_domain_regex = re.compile(r'^(\|\||\|\w+://)([^*:/]+)(:\d+)?(/.*)')
+tpl_trailing_slash_regex = re.compile(r'\s+/$')
+# Options not supported in MSIE but safe to ignore
+tpl_ignored_options = frozenset(['', 'third-party', '~third-party', 'match-case',
+                                 '~match-case', '~other', '~donottrack'])
+# Options for types not supported in MSIE
+tpl_unsupported_options = frozenset(['other', 'elemhide'])
+
+
+def combine_subscriptions(sources, target_dir, timeout=30, tempdir=None,
+                          diff_versions=0, optimize=False):
+    """Generate all subscription files from the given sources.
+
+    If `diff_versions` is set, the last `diff_versions` published versions of
+    every list are retained and diffs from each of them to the current version
+    are written into the diff/ directory, see `update_diffs()`. If `optimize`
+    is set, duplicate and redundant filters are removed, see
+    `optimize_filters()`.
+
+    Returns the names of the subscription files that couldn't be processed.
+    """
     if not os.path.exists(target_dir):
         os.makedirs(target_dir, 0755)
 
     def save_file(filename, data):
+        # data is either a string or an iterable of strings to be written
+        # one by one
+        if isinstance(data, basestring):
+            data = [data]
         handle = tempfile.NamedTemporaryFile(mode='wb', dir=tempdir, delete=False)
-        handle.write(data.encode('utf-8'))
+        for chunk in data:
+            handle.write(chunk.encode('utf-8'))
         handle.close()
 
         if hasattr(os, 'chmod'):
@@ -54,7 +101,19 @@ def combine_subscriptions(sources, target_dir, timeout=30, tempdir=None):
         os.rename(handle.name, path)
         os.rename(handle.name + '.gz', path + '.gz')
 
+    fingerprints_path = os.path.join(target_dir, fingerprints_file)
+    previous_fingerprints = load_fingerprints(fingerprints_path)
+    fingerprints = {}
+    include_cache = {}
+
+    def outputs_exist(filename):
+        tpl = os.path.splitext(filename)[0] + '.tpl'
+        return all(os.path.exists(os.path.join(target_dir, name))
+                   for name in (filename, filename + '.gz', tpl, tpl + '.gz'))
+
     known = set()
+    lists = set()
+    failed = []
     for source_name, source in sources.iteritems():
         for filename in source.list_top_level_files():
             if filename in ignore or filename.startswith('.'):
@@ -64,12 +123,24 @@ def combine_subscriptions(sources, target_dir, timeout=30, tempdir=None):
             elif not os.path.splitext(filename)[1] in accepted_extensions:
                 continue
             else:
+                known_inputs = None
+                if outputs_exist(filename):
+                    known_inputs = previous_fingerprints.get(filename)
                 try:
-                    process_subscription_file(source_name, sources, save_file, filename, timeout)
+                    inputs = process_subscription_file(
+                        source_name, sources, save_file, filename, timeout,
+                        include_cache, known_inputs, optimize,
+                    )
+                    if diff_versions and inputs != known_inputs:
+                        update_diffs(target_dir, save_file, filename,
+                                     diff_versions)
+                    fingerprints[filename] = inputs
                 except:
+                    failed.append(filename)
                     print >>sys.stderr, 'Error processing subscription file "%s"' % filename
                     traceback.print_exc()
                     print >>sys.stderr
+                lists.add(os.path.splitext(filename)[0])
                 known.add(os.path.splitext(filename)[0] + '.tpl')
                 known.add(os.path.splitext(filename)[0] + '.tpl.gz')
             known.add(filename)
@@ -78,31 +149,226 @@ def combine_subscriptions(sources, target_dir, timeout=30, tempdir=None):
     for filename in os.listdir(target_dir):
         if filename.startswith('.'):
             continue
+        if filename == diff_dir and diff_versions:
+            continue
         if not filename in known:
-            os.remove(os.path.join(target_dir, filename))
+            path = os.path.join(target_dir, filename)
+            if os.path.isdir(path):
+                shutil.rmtree(path)
+            else:
+                os.remove(path)
+
+    history = os.path.join(target_dir, history_dir)
+    if not diff_versions and os.path.isdir(history):
+        shutil.rmtree(history)
+    for parent in (history, os.path.join(target_dir, diff_dir)):
+        if not os.path.isdir(parent):
+            continue
+        for name in os.listdir(parent):
+            if not name in lists:
+                shutil.rmtree(os.path.join(parent, name))
+
+    save_fingerprints(fingerprints_path, fingerprints, tempdir)
+    return failed
+
+
+def fingerprint(data):
+    if isinstance(data, unicode):
+        data = data.encode('utf-8')
+    return hashlib.md5(data).hexdigest()
+
+
+def load_fingerprints(path):
+    """Read the input fingerprints recorded by the previous run."""
+    try:
+        with open(path, 'rb') as handle:
+            return json.load(handle)
+    except (IOError, ValueError):
+        return {}
+
+
+def remote_includes_changed(target_dir, timeout=30):
+    """Check whether remote includes used by the previous run changed since.
+
+    Failing to fetch one counts as a change.
+    """
+    fingerprints = load_fingerprints(os.path.join(target_dir, fingerprints_file))
+    remote = {}
+    for inputs in fingerprints.itervalues():
+        for key, value in inputs.iteritems():
+            if re.match(r'^https?://', key):
+                remote[key] = value
+
+    for url, expected in remote.iteritems():
+        try:
+            inputs = fetch_remote_include(url, timeout)[1]
+        except Exception:
+            return True
+        if inputs[url] != expected:
+            return True
+    return False
+
+
+def save_fingerprints(path, fingerprints, tempdir=None):
+    handle = tempfile.NamedTemporaryFile(mode='wb', dir=tempdir, delete=False)
+    with handle:
+        json.dump(fingerprints, handle, sort_keys=True)
+    os.rename(handle.name, path)
+
+
+def update_diffs(target_dir, save_file, filename, diff_versions):
+    """Write diffs to the freshly published version of a subscription file.
+
+    The published version is added to the list's history and for each of the
+    `diff_versions` previous versions a diff file diff/<list>/<version>.json is
+    written. It contains the changes to apply to the old list (sorted ranges of
+    old lines to be replaced by new lines) along with the new version and its
+    checksum, so that clients can verify the result the same way as for a full
+    download. diff/<list>/index.json lists the versions diffs exist for.
+    Older versions and diffs are removed.
+    """
+    name = os.path.splitext(filename)[0]
+    with codecs.open(os.path.join(target_dir, filename), 'rb', encoding='utf-8') as handle:
+        lines = handle.read().splitlines()
+    version = get_header_value(lines, 'Version')
+    checksum = get_header_value(lines, 'Checksum')
+
+    history = os.path.join(target_dir, history_dir, name)
+    diffs = os.path.join(target_dir, diff_dir, name)
+    for path in (history, diffs):
+        if not os.path.exists(path):
+            os.makedirs(path, 0755)
+
+    old_versions = sorted((os.path.splitext(f)[0] for f in os.listdir(history)
+                           if f.endswith('.txt')), reverse=True)
+    old_versions = [v for v in old_versions if v != version][:diff_versions]
+    for old_version in old_versions:
+        path = os.path.join(history, old_version + '.txt')
+        with codecs.open(path, 'rb', encoding='utf-8') as handle:
+            old_lines = handle.read().splitlines()
+        diff = {
+            'from': old_version,
+            'version': version,
+            'checksum': checksum,
+            'changes': calculate_changes(old_lines, lines),
+        }
+        save_file(os.path.join(diff_dir, name, old_version + '.json'),
+                  json.dumps(diff, sort_keys=True, separators=(',', ':')))
+
+    index = {'version': version, 'checksum': checksum, 'from': old_versions}
+    save_file(os.path.join(diff_dir, name, 'index.json'),
+              json.dumps(index, sort_keys=True, separators=(',', ':')))
+
+    shutil.copyfile(os.path.join(target_dir, filename),
+                    os.path.join(history, version + '.txt'))
+
+    keep = set(old_versions)
+    keep.add(version)
+    for f in os.listdir(history):
+        if os.path.splitext(f)[0] not in keep:
+            os.remove(os.path.join(history, f))
+    for f in os.listdir(diffs):
+        if f.split('.')[0] not in keep and f.split('.')[0] != 'index':
+            os.remove(os.path.join(diffs, f))
+
+
+def get_header_value(lines, key):
+    for line in lines:
+        match = re.search(r'^\s*!\s*%s\s*:\s*(.*)' % key, line, re.I)
+        if match:
+            return match.group(1).strip()
+        if line.startswith('[') or re.search(r'^\s*!', line):
+            continue
+        break
+    return None
+
+
+def calculate_changes(old_lines, new_lines):
+    """Return the changes turning old_lines into new_lines.
+
+    The result is a list of [start, end, lines] entries, meaning that the lines
+    start to end (exclusive) of the old list are replaced by the given lines.
+    """
+    matcher = difflib.SequenceMatcher(None, old_lines, new_lines)
+    return [[i1, i2, new_lines[j1:j2]]
+            for tag, i1, i2, j1, j2 in matcher.get_opcodes() if tag != 'equal']
+
+
+def apply_changes(lines, changes):
+    """Apply the changes from a diff file to the lines of the old list."""
+    result = []
+    position = 0
+    for start, end, new_lines in changes:
+        result.extend(lines[position:start])
+        result.extend(new_lines)
+        position = end
+    result.extend(lines[position:])
+    return result
+
+
+def calculate_checksum(header, lines):
+    """Calculate the checksum of a list.
+
+    It covers the header and the lines following the checksum comment.
+    """
+    checksum = hashlib.md5()
+    for chunk in join_lines(itertools.chain([header], lines)):
+        checksum.update(chunk.encode('utf-8'))
+    return base64.b64encode(checksum.digest()).rstrip('=')
+
+
+def verify_checksum(lines):
+    """Check a complete list against its checksum comment.
+
+    This is used to verify the result of applying a diff.
+    """
+    for i, line in enumerate(lines):
+        match = re.search(r'^\s*!\s*checksum[\s\-:]+([\w\+\/=]+)', line, re.I)
+        if match:
+            remaining = lines[1:i] + lines[i + 1:]
+            return calculate_checksum(lines[0], remaining) == match.group(1)
+    return False
 
 
 def process_verbatim_file(source, save_file, filename):
     save_file(filename, source.read_file(filename))
 
 
-def process_subscription_file(source_name, sources, save_file, filename, timeout):
+def process_subscription_file(source_name, sources, save_file, filename, timeout,
+                              include_cache=None, known_inputs=None,
+                              optimize=False):
+    """Convert a subscription file and save it along with its TPL version.
+
+    Returns a dict mapping all transitive inputs of the list (the file itself,
+    local and remote includes) to their fingerprints. If these match
+    `known_inputs` nothing is written, so the previously published list keeps
+    its version and checksum.
+    """
     source = sources[source_name]
-    lines = source.read_file(filename).splitlines()
+    data = source.read_file(filename)
+    lines = data.splitlines()
+    inputs = {source_name + ':' + filename: fingerprint(data)}
+    if optimize:
+        # Make sure that lists are rebuilt when optimization is toggled
+        inputs['optimize'] = True
 
     header = ''
     if len(lines) > 0:
         header = lines.pop(0)
-    if not re.search(r'\[Adblock(?:\s*Plus\s*([\d\.]+)?)?\]', header, re.I):
+    if not header_regex.search(header):
         raise Exception('This is not a valid Adblock Plus subscription file.')
 
-    lines = resolve_includes(source_name, sources, lines, timeout)
+    lines = resolve_includes(source_name, sources, lines, timeout,
+                             cache=include_cache, inputs=inputs)
+    if inputs == known_inputs:
+        return inputs
+
     seen = set(['checksum', 'version'])
 
     def check_line(line):
         if line == '':
             return False
-        match = re.search(r'^\s*!\s*(Redirect|Homepage|Title|Checksum|Version|Expires)\s*:', line, re.M | re.I)
+        match = special_comment_regex.search(line)
         if not match:
             return True
         key = match.group(1).lower()
@@ -112,47 +378,103 @@ def process_subscription_file(source_name, sources, save_file, filename, timeout
         return True
     lines = filter(check_line, lines)
 
+    if optimize:
+        lines, removed, saved = optimize_filters(lines)
+        logging.info('%s: removed %i duplicate or redundant filters, %i bytes saved',
+                     filename, removed, saved)
+
     write_tpl(save_file, os.path.splitext(filename)[0] + '.tpl', lines)
 
-    lines.insert(0, '! Version: %s' % time.strftime('%Y%m%d%H%M', time.gmtime()))
+    version = '! Version: %s' % time.strftime('%Y%m%d%H%M', time.gmtime())
+    checksum = calculate_checksum(header, itertools.chain([version], lines))
+    save_file(filename, join_lines(itertools.chain(
+        [header, '! Checksum: %s' % checksum, version], lines,
+    )))
+    return inputs
 
-    checksum = hashlib.md5()
-    checksum.update('\n'.join([header] + lines).encode('utf-8'))
-    lines.insert(0, '! Checksum: %s' % base64.b64encode(checksum.digest()).rstrip('='))
-    lines.insert(0, header)
-    save_file(filename, '\n'.join(lines))
+
+def optimize_filters(lines):
+    """Remove duplicate and redundant filters from a list.
+
+    Duplicates are removed, keeping the first occurrence, as well as blocking
+    and exception filters which only restrict an identical filter without
+    options in the same list. Comments are kept.
+
+    Returns the remaining lines, the number of removed filters and the number
+    of bytes saved.
+    """
+    unrestricted = set(line for line in lines
+                       if not comment_regex.match(line) and '$' not in line)
+
+    def is_redundant(line):
+        if '#' in line:
+            # Element hiding filters (and anything looking like them)
+            return False
+        base, separator, options = line.partition('$')
+        if not separator or base not in unrestricted:
+            return False
+        for option in options.replace('_', '-').lower().split(','):
+            option = option.lstrip('~').split('=', 1)[0]
+            if option not in restricting_options:
+                return False
+        return True
+
+    result = []
+    seen = set()
+    removed = saved = 0
+    for line in lines:
+        if not comment_regex.match(line):
+            if line in seen or is_redundant(line):
+                removed += 1
+                saved += len(line.encode('utf-8')) + 1
+                continue
+            seen.add(line)
+        result.append(line)
+    return result, removed, saved
+
+
+def join_lines(lines):
+    r"""Join lines like '\n'.join(lines), yielding the result line by line."""
+    lines = iter(lines)
+    for line in lines:
+        yield line
+        break
+    for line in lines:
+        yield '\n' + line
+
+
+def resolve_includes(source_name, sources, lines, timeout, level=0, cache=None,
+                     inputs=None):
+    """Replace %include% directives with the contents of the included files.
+
+    Resolved fragments are memoized in `cache` (if given) so that fragments
+    shared by several lists are only fetched and resolved once per run. The
+    fingerprints of all transitively included files are added to `inputs`.
+    """
+    if cache is None:
+        cache = {}
+    if inputs is None:
+        inputs = {}
+    return _resolve_includes(source_name, sources, lines, timeout, level,
+                             cache, inputs)[0]
 
 
-def resolve_includes(source_name, sources, lines, timeout, level=0):
+def _resolve_includes(source_name, sources, lines, timeout, level, cache,
+                      inputs):
     if level > 5:
         raise Exception('There are too many nested includes, which is probably the result of a circular reference somewhere.')
 
     result = []
+    height = 0
     for line in lines:
-        match = re.search(r'^\s*%include\s+(.*)%\s*$', line)
+        match = include_regex.search(line)
         if match:
             filename = match.group(1)
-            newlines = None
             if re.match(r'^https?://', filename):
                 result.append('! *** Fetched from: %s ***' % filename)
-
-                for i in range(3):
-                    try:
-                        request = urllib2.urlopen(filename, None, timeout)
-                        data = request.read()
-                        error = None
-                        break
-                    except urllib2.URLError as e:
-                        error = e
-                        time.sleep(5)
-                if error:
-                    raise error
-
-                # We should really get the charset from the headers rather than assuming
-                # that it is UTF-8. However, some of the Google Code mirrors are
-                # misconfigured and will return ISO-8859-1 as charset instead of UTF-8.
-                newlines = data.decode('utf-8').splitlines()
-                newlines = filter(lambda l: not re.search(r'^\s*!\s*(Redirect|Homepage|Title|Version|Expires)\s*:', l, re.M | re.I), newlines)
+                key = ('remote', filename)
+                if key not in cache:
+                    cache[key] = fetch_remote_include(filename, timeout)
             else:
                 result.append('! *** %s ***' % filename)
 
@@ -162,11 +484,27 @@ def resolve_includes(source_name, sources, lines, timeout, level=0):
                 if not include_source in sources:
                     raise Exception('Cannot include file from repository "%s", this repository is unknown' % include_source)
 
-                source = sources[include_source]
-                newlines = source.read_file(filename).splitlines()
-                newlines = resolve_includes(include_source, sources, newlines, timeout, level + 1)
-
-            if len(newlines) and re.search(r'\[Adblock(?:\s*Plus\s*([\d\.]+)?)?\]', newlines[0], re.I):
+                key = ('local', include_source, filename)
+                if key not in cache:
+                    data = sources[include_source].read_file(filename)
+                    fragment_inputs = {include_source + ':' + filename: fingerprint(data)}
+                    newlines, fragment_height = _resolve_includes(
+                        include_source, sources, data.splitlines(), timeout,
+                        level + 1, cache, fragment_inputs,
+                    )
+                    cache[key] = (newlines, fragment_inputs, fragment_height)
+
+            newlines, fragment_inputs, fragment_height = cache[key]
+            if fragment_height is not None:
+                # A memoized fragment might have been resolved at a lower
+                # nesting level, make sure that it doesn't exceed the limit here.
+                if level + 1 + fragment_height > 5:
+                    raise Exception('There are too many nested includes, which is probably the result of a circular reference somewhere.')
+                height = max(height, fragment_height + 1)
+            inputs.update(fragment_inputs)
+
+            newlines = list(newlines)
+            if len(newlines) and header_regex.search(newlines[0]):
                 del newlines[0]
             result.extend(newlines)
         else:
@@ -176,109 +514,151 @@ def resolve_includes(source_name, sources, lines, timeout, level=0):
                 else:
                     line = ''
             result.append(line)
-    return result
+    return result, height
+
+
+def fetch_remote_include(url, timeout):
+    for i in range(3):
+        try:
+            request = urllib2.urlopen(url, None, timeout)
+            data = request.read()
+            error = None
+            break
+        except urllib2.URLError as e:
+            error = e
+            time.sleep(5)
+    if error:
+        raise error
+
+    # We should really get the charset from the headers rather than assuming
+    # that it is UTF-8. However, some of the Google Code mirrors are
+    # misconfigured and will return ISO-8859-1 as charset instead of UTF-8.
+    lines = data.decode('utf-8').splitlines()
+    lines = filter(lambda l: not remote_special_comment_regex.search(l), lines)
+    return lines, {url: fingerprint(data)}, None
 
 
 def write_tpl(save_file, filename, lines):
-    result = []
-    result.append('msFilterList')
+    save_file(filename, (line + '\n' for line in convert_to_tpl(lines)))
+
+
+def convert_to_tpl(lines):
+    """Convert filters to the Tracking Protection List format used by MSIE.
+
+    The resulting lines are yielded one by one.
+    """
+    yield 'msFilterList'
     for line in lines:
-        if re.search(r'^\s*!', line):
-            # This is a comment. Handle "Expires" comment in a special way, keep the rest.
-            match = re.search(r'^\s*!\s*Expires\s*:\s*(\d+)\s*(h)?', line, re.I)
-            if match:
-                interval = int(match.group(1))
-                if match.group(2):
-                    interval = int(interval / 24)
-                result.append(': Expires=%i' % interval)
-            else:
-                result.append(re.sub(r'^\s*!', '#', re.sub(r'--!$', '--#', line)))
-        elif line.find('#') >= 0:
+        if comment_regex.match(line):
+            yield convert_tpl_comment(line)
+        elif '#' in line:
             # Element hiding rules are not supported in MSIE, drop them
             pass
         else:
-            # We have a blocking or exception rule, try to convert it
-            origline = line
-
-            is_exception = False
-            if line.startswith('@@'):
-                is_exception = True
-                line = line[2:]
-
-            has_unsupported = False
-            requires_script = False
-            match = re.search(r'^(.*?)\$(.*)', line)
-            if match:
-                # This rule has options, check whether any of them are important
-                line = match.group(1)
-                options = match.group(2).replace('_', '-').lower().split(',')
-
-                # Remove first-party only exceptions, we will allow an ad server everywhere otherwise
-                if is_exception and '~third-party' in options:
-                    has_unsupported = True
-
-                # A number of options are not supported in MSIE but can be safely ignored, remove them
-                options = filter(lambda o: not o in ('', 'third-party', '~third-party', 'match-case', '~match-case', '~other', '~donottrack'), options)
-
-                # Also ignore domain negation of whitelists
-                if is_exception:
-                    options = filter(lambda o: not o.startswith('domain=~'), options)
-
-                unsupported = filter(lambda o: o in ('other', 'elemhide'), options)
-                if unsupported and len(unsupported) == len(options):
-                    # The rule only applies to types that are not supported in MSIE
-                    has_unsupported = True
-                elif 'donottrack' in options:
-                    # Do-Not-Track rules have to be removed even if $donottrack is combined with other options
-                    has_unsupported = True
-                elif 'script' in options and len(options) == len(unsupported) + 1:
-                    # Mark rules that only apply to scripts for approximate conversion
-                    requires_script = True
-                elif len(options) > 0:
-                    # The rule has further options that aren't available in TPLs. For
-                    # exception rules that aren't specific to a domain we ignore all
-                    # remaining options to avoid potential false positives. Other rules
-                    # simply aren't included in the TPL file.
-                    if is_exception:
-                        has_unsupported = any([o.startswith('domain=') for o in options])
-                    else:
-                        has_unsupported = True
-
-            if has_unsupported:
-                # Do not include filters with unsupported options
-                result.append('# ' + origline)
+            yield convert_tpl_filter(line)
+
+
+def convert_tpl_comment(line):
+    # Handle "Expires" comment in a special way, keep the rest.
+    match = tpl_expires_regex.match(line)
+    if match:
+        interval = int(match.group(1))
+        if match.group(2):
+            interval = int(interval / 24)
+        return ': Expires=%i' % interval
+    if line.endswith('--!'):
+        line = line[:-1] + '#'
+    return comment_regex.sub('#', line, 1)
+
+
+def split_filter(line):
+    """Split a blocking or exception filter into its parts.
+
+    Returns the exception flag, the pattern and the (normalized) list of
+    options.
+    """
+    is_exception = line.startswith('@@')
+    if is_exception:
+        line = line[2:]
+    pattern, separator, options = line.partition('$')
+    if not separator:
+        return is_exception, pattern, None
+    return is_exception, pattern, options.replace('_', '-').lower().split(',')
+
+
+def convert_tpl_filter(origline):
+    is_exception, line, options = split_filter(origline)
+
+    has_unsupported = False
+    requires_script = False
+    if options is not None:
+        # This rule has options, check whether any of them are important
+
+        # Remove first-party only exceptions, we will allow an ad server everywhere otherwise
+        if is_exception and '~third-party' in options:
+            has_unsupported = True
+
+        # A number of options are not supported in MSIE but can be safely
+        # ignored, remove them. Also ignore domain negation of whitelists.
+        options = [o for o in options if o not in tpl_ignored_options and
+                   not (is_exception and o.startswith('domain=~'))]
+
+        unsupported = len([o for o in options if o in tpl_unsupported_options])
+        if unsupported and unsupported == len(options):
+            # The rule only applies to types that are not supported in MSIE
+            has_unsupported = True
+        elif 'donottrack' in options:
+            # Do-Not-Track rules have to be removed even if $donottrack is combined with other options
+            has_unsupported = True
+        elif 'script' in options and len(options) == unsupported + 1:
+            # Mark rules that only apply to scripts for approximate conversion
+            requires_script = True
+        elif len(options) > 0:
+            # The rule has further options that aren't available in TPLs. For
+            # exception rules that aren't specific to a domain we ignore all
+            # remaining options to avoid potential false positives. Other rules
+            # simply aren't included in the TPL file.
+            if is_exception:
+                has_unsupported = any(o.startswith('domain=') for o in options)
             else:
-                line = line.replace('^', '/')  # Assume that separator placeholders mean slashes
-
-                # Try to extract domain info
-                domain = None
-                match = re.search(r'^(\|\||\|\w+://)([^*:/]+)(:\d+)?(/.*)', line)
-                if match:
-                    domain = match.group(2)
-                    line = match.group(4)
-                else:
-                    # No domain info, remove anchors at the rule start
-                    line = re.sub(r'^\|\|', 'http://', line)
-                    line = re.sub(r'^\|', '', line)
-                # Remove anchors at the rule end
-                line = re.sub(r'\|$', '', line)
-                # Remove unnecessary asterisks at the ends of lines
-                line = re.sub(r'\*$', '', line)
-                # Emulate $script by appending *.js to the rule
-                if requires_script:
-                    line += '*.js'
-                if line.startswith('/*'):
-                    line = line[2:]
-                if domain:
-                    line = '%sd %s %s' % ('+' if is_exception else '-', domain, line)
-                    line = re.sub(r'\s+/$', '', line)
-                    result.append(line)
-                elif is_exception:
-                    # Exception rules without domains are unsupported
-                    result.append('# ' + origline)
-                else:
-                    result.append('- ' + line)
-    save_file(filename, '\n'.join(result) + '\n')
+                has_unsupported = True
+
+    if has_unsupported:
+        # Do not include filters with unsupported options
+        return '# ' + origline
+
+    line = line.replace('^', '/')  # Assume that separator placeholders mean slashes
+
+    # Try to extract domain info
+    domain = None
+    match = tpl_domain_regex.match(line)
+    if match:
+        domain = match.group(2)
+        line = match.group(4)
+    elif line.startswith('||'):
+        # No domain info, remove anchors at the rule start
+        line = 'http://' + line[2:]
+    elif line.startswith('|'):
+        line = line[1:]
+    # Remove anchors at the rule end
+    if line.endswith('|'):
+        line = line[:-1]
+    # Remove unnecessary asterisks at the ends of lines
+    if line.endswith('*'):
+        line = line[:-1]
+    # Emulate $script by appending *.js to the rule
+    if requires_script:
+        line += '*.js'
+    if line.startswith('/*'):
+        line = line[2:]
+    if domain:
+        line = '%sd %s %s' % ('+' if is_exception else '-', domain, line)
+        return tpl_trailing_slash_regex.sub('', line)
+    elif is_exception:
+        # Exception rules without domains are unsupported
+        return '# ' + origline
+    else:
+        return '- ' + line
 
 
 class FileSource:
@@ -311,12 +691,14 @@ def usage():
 Options:
   -h          --help              Print this message and exit
   -t seconds  --timeout=seconds   Timeout when fetching remote subscriptions
+  -d count    --diffs=count       Number of previous versions to generate diffs for
+  -o          --optimize          Remove duplicate and redundant filters
 ''' % os.path.basename(sys.argv[0])
 
 
 if __name__ == '__main__':
     try:
-        opts, args = getopt(sys.argv[1:], 'ht:', ['help', 'timeout='])
+        opts, args = getopt(sys.argv[1:], 'ht:d:o', ['help', 'timeout=', 'diffs=', 'optimize'])
     except GetoptError as e:
         print str(e)
         usage()
@@ -334,11 +716,19 @@ if __name__ == '__main__':
         sources[''] = FileSource('.')
 
     timeout = 30
+    diff_versions = 0
+    optimize = False
     for option, value in opts:
         if option in ('-h', '--help'):
             usage()
             sys.exit()
         elif option in ('-t', '--timeout'):
             timeout = int(value)
-
-    combine_subscriptions(sources, target_dir, timeout)
+        elif option in ('-d', '--diffs'):
+            diff_versions = int(value)
+        elif option in ('-o', '--optimize'):
+            optimize = True
+            logging.basicConfig(level=logging.INFO, format='%(message)s')
+
+    combine_subscriptions(sources, target_dir, timeout,
+                          diff_versions=diff_versions, optimize=optimize)
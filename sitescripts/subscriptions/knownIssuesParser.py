@@ -17,6 +17,7 @@ import subprocess
 import sys
 import os
 import re
+import threading
 from sitescripts.utils import get_config, cached
 
 supportedKeys = {
@@ -81,11 +82,8 @@ class Ruleset:
             print >>sys.stderr, 'Ruleset "%s" doesn\'t have a URL defined' % self.name
 
     @property
-    def matched(self):
-        for rule in self._rules:
-            if not rule.matched:
-                return False
-        return True
+    def rules(self):
+        return self._rules
 
     url = None
 
@@ -94,7 +92,6 @@ class Rule:
     def __init__(self, key, value):
         value = value.lower()
 
-        self.matched = False
         self.key = key
         self.patterns = []
         self.addPattern(value)
@@ -118,40 +115,139 @@ class Rule:
             value = re.sub(r'\\\|$', r'$', value)    # process anchor at expression end
             self.patterns.append(re.compile(value))
 
-    def checkMatch(self, value):
-        if self.matched:
+
+class KeyMatcher(object):
+    """Match the values of one key against all rules for that key.
+
+    The patterns of all rules are merged into a single regular expression
+    first. Most values don't match any rule, and those are rejected by a
+    single search. Only when the combined expression matches are the
+    individual rules checked.
+    """
+
+    def __init__(self, entries):
+        self._entries = entries
+        self._prefilter = None
+        sources = [pattern.pattern for ruleId, patterns in entries
+                   for pattern in patterns]
+        # Back references would point to the wrong groups once combined
+        if not any(re.search(r'\\[1-9]|\(\?P=', s) for s in sources):
+            try:
+                self._prefilter = re.compile('|'.join('(?:%s)' % s for s in sources))
+            except re.error:
+                pass
+
+    def match(self, value, matched):
+        """Add the ids of the rules matching the value to `matched`."""
+        if self._prefilter is not None and not self._prefilter.search(value):
             return
+        for ruleId, patterns in self._entries:
+            if ruleId not in matched and any(p.search(value) for p in patterns):
+                matched.add(ruleId)
+
+
+class Matcher(object):
+    """Compiled known issues rules, matching report elements against them.
+
+    A matcher holds no state about any particular report, so a single
+    instance can be shared between threads.
+    """
+
+    def __init__(self, rules, rulesets):
+        ruleIds = {}
+        self._keys = {}
+        for key, ruleGroup in rules.iteritems():
+            entries = []
+            for rule in ruleGroup:
+                ruleIds[rule] = len(ruleIds)
+                entries.append((ruleIds[rule], rule.patterns))
+            self._keys[key] = KeyMatcher(entries)
+
+        self._rulesets = [
+            (ruleset.url, [ruleIds[rule] for rule in ruleset.rules])
+            for ruleset in rulesets if ruleset.url
+        ]
+
+        # Maps each tag to the keys which get their values from it
+        self._tags = {}
+        for key, t in supportedKeys.iteritems():
+            if key not in self._keys:
+                continue
+            if len(t) == 3:
+                tag, attrs, requiredValue = t
+            else:
+                tag, attrs = t
+                requiredValue = None
+            self._tags.setdefault(tag, []).append((key, attrs.split(' '), requiredValue))
+
+        # Tags whose text content is matched rather than their attributes
+        self.textTags = {tag for tag, keys in self._tags.iteritems()
+                         if any(k[2] != None for k in keys)}
+
+    def start(self):
+        """Return a new MatchState for matching a single report."""
+        return MatchState(self)
+
+    def match(self, elements, lang):
+        """Return the URLs of the known issues matching the report.
+
+        `elements` yields a (tag, attributes, text) tuple for each element of
+        the report.
+        """
+        state = self.start()
+        for tag, attrs, text in elements:
+            state.element(tag, attrs, text)
+        return state.result(lang)
+
+    def matchElement(self, tag, attrs, text, matched):
+        for key, requiredAttrs, requiredValue in self._tags.get(tag, ()):
+            foundAttrs = [attrs[attr] for attr in requiredAttrs if attr in attrs]
+            if len(foundAttrs) != len(requiredAttrs):
+                continue
+
+            value = ' '.join(foundAttrs)
+            if requiredValue != None:
+                if requiredValue != value:
+                    continue
+                value = text
 
-        for pattern in self.patterns:
-            if re.search(pattern, value):
-                self.matched = True
-                break
+            self._keys[key].match(value.lower(), matched)
 
+    def matchedURLs(self, matched):
+        result = set()
+        for url, ruleIds in self._rulesets:
+            if all(ruleId in matched for ruleId in ruleIds):
+                result.add(url)
+        return sorted(result)
 
-def resetMatches(rules):
-    for ruleGroup in rules.itervalues():
-        for rule in ruleGroup:
-            rule.matched = False
 
+class MatchState(object):
+    """Known issues matching of a single report, fed one element at a time.
 
-def checkMatch(rules, key, value):
-    value = value.lower()
-    if key in rules:
-        for rule in rules[key]:
-            rule.checkMatch(value)
+    This allows matching the elements while the report is being parsed for
+    other purposes anyway.
+    """
 
+    def __init__(self, matcher):
+        self._matcher = matcher
+        self._matched = set()
+        self.textTags = matcher.textTags
 
-def extractMatches(rules, rulesets, lang):
-    result = {}
-    for ruleset in rulesets:
-        if ruleset.matched:
-            url = re.sub(r'%LANG%', lang, ruleset.url)
-            result[url] = True
-    resetMatches(rules)
+    def element(self, tag, attrs, text):
+        """Match an element given its attributes and text content."""
+        self._matcher.matchElement(tag, attrs, text, self._matched)
 
-    result = result.keys()
-    result.sort()
-    return result
+    def urls(self):
+        """Return the URLs of the matched known issues, %LANG% unreplaced."""
+        return self._matcher.matchedURLs(self._matched)
+
+    def result(self, lang):
+        """Return the URLs of the matched known issues for the language."""
+        return localizeURLs(self.urls(), lang)
+
+
+def localizeURLs(urls, lang):
+    return sorted({url.replace('%LANG%', lang) for url in urls})
 
 
 @cached(600)
@@ -159,7 +255,11 @@ def getRules():
     repoPath = os.path.abspath(get_config().get('subscriptions', 'repository'))
 
     data = subprocess.check_output(['hg', '-R', repoPath, 'cat', '-r', 'default', os.path.join(repoPath, 'knownIssues')])
-    data = data.decode('utf-8').replace('\r', '').split('\n')
+    return parseRules(data.decode('utf-8').replace('\r', '').split('\n'))
+
+
+def parseRules(data):
+    data = list(data)
     data.append('[]')   # Pushes out last section
 
     rules = {}
@@ -196,11 +296,22 @@ def getRules():
     return (rules, rulesets)
 
 
-def findMatches(it, lang):
-    global supportedKeys
+def getMatcher():
+    global _matcher
+
+    # Compile the rules only once for each result of getRules()
+    rules = getRules()
+    with _matcherLock:
+        if _matcher is None or _matcher[0] is not rules:
+            _matcher = (rules, Matcher(*rules))
+        return _matcher[1]
+
 
-    rules, rulesets = getRules()
+_matcher = None
+_matcherLock = threading.Lock()
 
+
+def iterLineElements(it):
     for line in it:
         match = re.search(r'<([\w\-]+)\s*(.*?)\s*/?>([^<>]*)', line)
         if not match:
@@ -213,29 +324,8 @@ def findMatches(it, lang):
         attrs = {}
         for match in re.finditer(r'(\w+)="([^"]*)"', attrText):
             attrs[match.group(1)] = match.group(2).strip().replace('&lt;', '<').replace('&gt;', '>').replace('&quot;', '"').replace('&amp;', '&')
+        yield tag, attrs, text
 
-        for key, t in supportedKeys.iteritems():
-            if len(t) == 3:
-                requiredTag, requiredAttrs, requiredValue = t
-            else:
-                requiredTag, requiredAttrs = t
-                requiredValue = None
-            requiredAttrs = requiredAttrs.split(' ')
-            if requiredTag != tag:
-                continue
 
-            foundAttrs = []
-            for attr in requiredAttrs:
-                if attr in attrs:
-                    foundAttrs.append(attrs[attr])
-            if len(foundAttrs) != len(requiredAttrs):
-                continue
-
-            value = ' '.join(foundAttrs)
-            if requiredValue != None:
-                if requiredValue != value:
-                    continue
-                value = text
-
-            checkMatch(rules, key, value)
-    return extractMatches(rules, rulesets, lang)
+def findMatches(it, lang):
+    return getMatcher().match(iterLineElements(it), lang)
@@ -0,0 +1,223 @@
+# This file is part of the Adblock Plus web scripts,
+# Copyright (C) 2006-present eyeo GmbH
+#
+# Adblock Plus is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 3 as
+# published by the Free Software Foundation.
+#
+# Adblock Plus is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Adblock Plus.  If not, see <http://www.gnu.org/licenses/>.
+
+import io
+import json
+import re
+import shutil
+
+import pytest
+
+from sitescripts.subscriptions import combineSubscriptions
+from sitescripts.subscriptions.combineSubscriptions import (
+    combine_subscriptions, resolve_includes, apply_changes, verify_checksum,
+    remote_includes_changed, optimize_filters,
+)
+
+
+class DictSource:
+    """A subscription source serving files from a dict, counting reads."""
+
+    def __init__(self, files):
+        self.files = files
+        self.reads = {}
+
+    def read_file(self, filename):
+        self.reads[filename] = self.reads.get(filename, 0) + 1
+        return self.files[filename]
+
+    def list_top_level_files(self):
+        return [name for name in self.files if '/' not in name]
+
+
+@pytest.fixture(autouse=True)
+def compressor(mocker):
+    """Replace 7za by a plain copy of the file."""
+    def check_output(command):
+        shutil.copy(command[-1], command[-2])
+    mocker.patch.object(combineSubscriptions.subprocess, 'check_output',
+                        check_output)
+
+
+@pytest.fixture
+def source():
+    return DictSource({
+        'a.txt': u'[Adblock Plus 2.0]\n%include shared/common.txt%\na1',
+        'b.txt': u'[Adblock Plus 2.0]\n%include shared/common.txt%\nb1',
+        'c.txt': u'[Adblock Plus 2.0]\n! Title: C\nc1',
+        'shared/common.txt': u'[Adblock]\n%include shared/nested.txt%\nc',
+        'shared/nested.txt': u'nested1',
+    })
+
+
+def test_shared_fragments_resolved_once(tmpdir, source):
+    combine_subscriptions({'': source}, tmpdir.strpath)
+
+    assert source.reads['shared/common.txt'] == 1
+    assert source.reads['shared/nested.txt'] == 1
+    for name in ['a', 'b']:
+        lines = tmpdir.join(name + '.txt').read().splitlines()
+        assert lines[-4:] == ['! *** shared/nested.txt ***', 'nested1',
+                              'c', name + '1']
+
+
+def test_unchanged_lists_not_rewritten(tmpdir, source):
+    combine_subscriptions({'': source}, tmpdir.strpath)
+    published = {name: tmpdir.join(name).read()
+                 for name in ['a.txt', 'b.txt', 'c.txt']}
+    for name in published:
+        tmpdir.join(name).write(published[name] + '\n! marker')
+
+    source.files['shared/nested.txt'] = u'nested2'
+    combine_subscriptions({'': source}, tmpdir.strpath)
+
+    assert 'nested2' in tmpdir.join('a.txt').read()
+    assert 'nested2' in tmpdir.join('b.txt').read()
+    assert tmpdir.join('c.txt').read() == published['c.txt'] + '\n! marker'
+
+
+def test_missing_output_rebuilt(tmpdir, source):
+    combine_subscriptions({'': source}, tmpdir.strpath)
+    tmpdir.join('c.tpl').remove()
+
+    combine_subscriptions({'': source}, tmpdir.strpath)
+    assert tmpdir.join('c.tpl').check()
+
+
+def test_circular_include():
+    source = DictSource({'a': u'%include b%', 'b': u'%include a%'})
+    with pytest.raises(Exception) as error:
+        resolve_includes('', {'': source}, ['%include a%'], 30)
+    assert 'too many nested includes' in str(error.value)
+
+
+def test_memoized_fragment_nesting_limit():
+    files = {'f0': u'x'}
+    for i in range(1, 6):
+        files['f%d' % i] = u'%%include f%d%%' % (i - 1)
+    source = DictSource(files)
+    cache = {}
+
+    resolve_includes('', {'': source}, ['%include f4%'], 30, cache=cache)
+    with pytest.raises(Exception):
+        resolve_includes('', {'': source}, ['%include f5%'], 30, cache=cache)
+
+
+@pytest.fixture
+def versions(mocker):
+    """Make every run publish a new version."""
+    versions = iter(range(201801010000, 201801010100))
+    mocker.patch.object(combineSubscriptions.time, 'strftime',
+                        lambda format, t: str(next(versions)))
+
+
+def test_diffs(tmpdir, source, versions):
+    published = []
+    for i in range(4):
+        source.files['c.txt'] = u'[Adblock Plus 2.0]\nc%d\nc\n%d' % (i, i)
+        combine_subscriptions({'': source}, tmpdir.strpath, diff_versions=2)
+        published.append(tmpdir.join('c.txt').read().decode('utf-8'))
+
+    versions = [re.search(r'! Version: (\d+)', content).group(1)
+                for content in published]
+    old_versions = versions[2:0:-1]
+    diffs = tmpdir.join('diff', 'c')
+    index = json.loads(diffs.join('index.json').read())
+    assert index['version'] == versions[-1]
+    assert index['from'] == old_versions
+    assert sorted(f.basename for f in diffs.listdir()) == sorted(
+        v + ext for v in old_versions + ['index']
+        for ext in ['.json', '.json.gz']
+    )
+
+    for old_version, old_list in zip(old_versions, published[2::-1]):
+        diff = json.loads(diffs.join(old_version + '.json').read())
+        assert diff['from'] == old_version
+        assert diff['version'] == index['version']
+        lines = apply_changes(old_list.splitlines(), diff['changes'])
+        assert lines == published[-1].splitlines()
+        assert verify_checksum(lines)
+        assert '! Checksum: ' + diff['checksum'] in lines
+
+
+def test_diffs_removed_list(tmpdir, source, versions):
+    combine_subscriptions({'': source}, tmpdir.strpath, diff_versions=2)
+    assert tmpdir.join('diff', 'c', 'index.json').check()
+
+    del source.files['c.txt']
+    combine_subscriptions({'': source}, tmpdir.strpath, diff_versions=2)
+    assert not tmpdir.join('diff', 'c').check()
+    assert tmpdir.join('diff', 'a').check()
+
+
+def test_remote_includes_changed(tmpdir, source, mocker):
+    remote = {'data': 'remote1'}
+    mocker.patch.object(combineSubscriptions.urllib2, 'urlopen',
+                        lambda url, data, timeout: io.BytesIO(remote['data']))
+    source.files['c.txt'] += u'\n%include http://example.com/list.txt%'
+
+    combine_subscriptions({'': source}, tmpdir.strpath)
+    assert 'remote1' in tmpdir.join('c.txt').read()
+    assert not remote_includes_changed(tmpdir.strpath)
+
+    remote['data'] = 'remote2'
+    assert remote_includes_changed(tmpdir.strpath)
+
+
+def test_optimize_filters():
+    lines = [
+        u'! *** a.txt ***',
+        u'||example.com^',
+        u'@@||example.com^$document',
+        u'##.ad',
+        u'! *** b.txt ***',
+        u'||example.com^',
+        u'||example.com^$script,~third_party,domain=foo.com|~bar.com',
+        u'||example.com^$popup',
+        u'||example.com^$csp=script-src *',
+        u'@@||example.com^$script',
+        u'example.com##.ad',
+        u'##.ad',
+        u'/ads$/',
+        u'/ads$/',
+        u'\u00e4rger',
+        u'\u00e4rger$image',
+    ]
+    result, removed, saved = optimize_filters(lines)
+    assert result == [
+        u'! *** a.txt ***',
+        u'||example.com^',
+        u'@@||example.com^$document',
+        u'##.ad',
+        u'! *** b.txt ***',
+        u'||example.com^$popup',
+        u'||example.com^$csp=script-src *',
+        u'@@||example.com^$script',
+        u'example.com##.ad',
+        u'/ads$/',
+        u'\u00e4rger',
+    ]
+    assert removed == 5
+    assert saved == sum(len(line.encode('utf-8')) + 1 for line in lines) - \
+        sum(len(line.encode('utf-8')) + 1 for line in result)
+
+
+def test_optimize_toggle_rebuilds(tmpdir, source):
+    source.files['c.txt'] += u'\nc1'
+    combine_subscriptions({'': source}, tmpdir.strpath)
+    assert tmpdir.join('c.txt').read().count('c1') == 2
+
+    combine_subscriptions({'': source}, tmpdir.strpath, optimize=True)
+    assert tmpdir.join('c.txt').read().count('c1') == 1
@@ -0,0 +1,195 @@
+# This file is part of the Adblock Plus web scripts,
+# Copyright (C) 2006-present eyeo GmbH
+#
+# Adblock Plus is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 3 as
+# published by the Free Software Foundation.
+#
+# Adblock Plus is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Adblock Plus.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Tests for matching reports against the known issues rules.
+
+Run this file directly to benchmark the matcher against a naive
+implementation checking every pattern on its own, on a large report.
+"""
+
+import re
+import sys
+import threading
+import time
+
+import pytest
+
+from sitescripts.subscriptions import knownIssuesParser
+from sitescripts.subscriptions.knownIssuesParser import (
+    Matcher, parseRules, iterLineElements, supportedKeys,
+)
+
+KNOWN_ISSUES = '''
+# Comment
+[Ads on example.com]
+mainURL = ||example.com^
+requestLocation = ads.example.com
+url = https://example.com/issues/ads?lang=%LANG%
+
+[Broken downloads]
+filterText = /^\\|\\|downloads\\./
+filterText = ||cdn.example.org/dl/*
+isEnabled = true
+url = https://example.com/issues/downloads
+
+[Old Firefox]
+appname = firefox
+appversion = /^(3|4)\\./
+url = https://example.com/issues/firefox
+
+[Repeated letters]
+requestLocation = /(\\w)\\1{3}/
+url = https://example.com/issues/repeated
+'''
+
+REPORT = '''<?xml version="1.0"?>
+<report type="false positive">
+  <application name="Firefox" version="3.6"/>
+  <window url="http://www.example.com/page"/>
+  <request location="http://ads.example.com/banner.js" type="SCRIPT"/>
+  <request location="http://example.net/aaaa.png" type="IMAGE"/>
+  <filter text="||downloads.example.org^" subscriptions="~fl~"/>
+  <option id="enabled">true</option>
+</report>
+'''
+
+
+def naive_find_matches(rules, rulesets, lines, lang):
+    matched = set()
+    for tag, attrs, text in iterLineElements(lines):
+        for key, t in supportedKeys.iteritems():
+            if t[0] != tag:
+                continue
+            required = t[1].split(' ')
+            found = [attrs[attr] for attr in required if attr in attrs]
+            if len(found) != len(required):
+                continue
+            value = ' '.join(found)
+            if len(t) == 3:
+                if t[2] != value:
+                    continue
+                value = text
+            for rule in rules.get(key, []):
+                if any(re.search(p, value.lower()) for p in rule.patterns):
+                    matched.add(rule)
+    return sorted({
+        ruleset.url.replace('%LANG%', lang) for ruleset in rulesets
+        if all(rule in matched for rule in ruleset.rules)
+    })
+
+
+@pytest.fixture
+def rules(mocker):
+    rules = parseRules(KNOWN_ISSUES.split('\n'))
+    mocker.patch.object(knownIssuesParser, 'getRules', return_value=rules)
+    return rules
+
+
+def test_find_matches(rules):
+    assert knownIssuesParser.findMatches(REPORT.splitlines(), 'de') == [
+        'https://example.com/issues/ads?lang=de',
+        'https://example.com/issues/downloads',
+        'https://example.com/issues/firefox',
+        'https://example.com/issues/repeated',
+    ]
+
+
+def test_partial_ruleset_not_matched(rules):
+    report = REPORT.replace('ads.example.com', 'example.com')
+    report = report.replace('">true</option>', '">false</option>')
+
+    assert knownIssuesParser.findMatches(report.splitlines(), 'en-US') == [
+        'https://example.com/issues/firefox',
+        'https://example.com/issues/repeated',
+    ]
+
+
+def test_same_as_naive_matcher(rules):
+    lines = large_report(200)
+
+    assert knownIssuesParser.findMatches(lines, 'en') == \
+        naive_find_matches(rules[0], rules[1], lines, 'en')
+
+
+def test_matcher_compiled_once(rules, mocker):
+    assert knownIssuesParser.getMatcher() is knownIssuesParser.getMatcher()
+
+    knownIssuesParser.getRules.return_value = parseRules(['[Other]', 'url=x'])
+    assert knownIssuesParser.findMatches([], 'en') == ['x']
+
+
+def test_concurrent_matching(rules):
+    expected = knownIssuesParser.findMatches(REPORT.splitlines(), 'en')
+    mismatches = []
+
+    def run(lines, expected):
+        for i in range(50):
+            if knownIssuesParser.findMatches(lines, 'en') != expected:
+                mismatches.append(lines)
+
+    threads = [
+        threading.Thread(target=run, args=args) for args in
+        [(REPORT.splitlines(), expected), (['<report type="other"/>'], [])] * 4
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert mismatches == []
+
+
+def large_report(requests):
+    lines = ['<report type="false positive">',
+             '<window url="http://www.example.com/"/>']
+    for i in range(requests):
+        lines.append('<request location="http://host%d.example.net/%d.js" '
+                     'docDomain="example.com"/>' % (i % 50, i))
+        lines.append('<filter text="||host%d.example.net^" '
+                     'subscriptions="~fl~"/>' % i)
+    lines.append('</report>')
+    return lines
+
+
+def large_rules(rulesets):
+    lines = []
+    for i in range(rulesets):
+        lines += ['[Issue %d]' % i,
+                  'requestLocation = ||tracker%d.example.com^' % i,
+                  'filterText = /^@@\\|\\|site%d\\./' % i,
+                  'mainURL = *.example.org/page%d' % i,
+                  'url = https://example.com/issues/%d' % i]
+    return parseRules(lines)
+
+
+def benchmark(requests=2000, rulesets=300, runs=3):
+    rules = large_rules(rulesets)
+    lines = large_report(requests)
+    matcher = Matcher(*rules)
+    for name, find in [
+        ('naive', lambda: naive_find_matches(rules[0], rules[1], lines, 'en')),
+        ('compiled', lambda: matcher.match(iterLineElements(lines), 'en')),
+    ]:
+        timings = []
+        for i in range(runs):
+            start = time.time()
+            find()
+            timings.append(time.time() - start)
+        print '%-8s %d lines, %d rulesets: %.3fs' % (name, len(lines),
+                                                     rulesets, min(timings))
+
+
+if __name__ == '__main__':
+    benchmark(*map(int, sys.argv[1:]))
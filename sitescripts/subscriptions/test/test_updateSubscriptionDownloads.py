@@ -0,0 +1,155 @@
+# This file is part of the Adblock Plus web scripts,
+# Copyright (C) 2006-present eyeo GmbH
+#
+# Adblock Plus is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 3 as
+# published by the Free Software Foundation.
+#
+# Adblock Plus is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Adblock Plus.  If not, see <http://www.gnu.org/licenses/>.
+
+import ConfigParser
+import logging
+import os
+
+import pytest
+
+from sitescripts.subscriptions.bin import updateSubscriptionDownloads
+from sitescripts.subscriptions.bin.updateSubscriptionDownloads import (
+    MercurialSnapshotSource, update_subscription_downloads,
+)
+
+CONF_SECTION = 'subscriptionDownloads'
+
+
+class MockRepository:
+    """Simulate hg for a repository with the given files."""
+
+    def __init__(self, files):
+        self.files = files
+        self.revision = '1' * 40
+        self.archives = 0
+
+    def check_output(self, command):
+        assert command[3:] == ['log', '-r', 'default', '--template', '{node}']
+        return self.revision + '\n'
+
+    def check_call(self, command):
+        assert command[3] == 'archive'
+        assert self.revision in command
+        self.archives += 1
+        for name, data in self.files.iteritems():
+            with open(os.path.join(command[-1], name), 'wb') as handle:
+                handle.write(data.encode('utf-8'))
+
+
+@pytest.fixture
+def repository(mocker):
+    repository = MockRepository({'a.txt': u'[Adblock Plus 2.0]\na1'})
+    subprocess = updateSubscriptionDownloads.subprocess
+    mocker.patch.object(subprocess, 'check_output', repository.check_output)
+    mocker.patch.object(subprocess, 'check_call', repository.check_call)
+    return repository
+
+
+@pytest.fixture
+def config(mocker, tmpdir):
+    config = ConfigParser.ConfigParser()
+    config.add_section(CONF_SECTION)
+    config.set(CONF_SECTION, 'test_repository', tmpdir.join('repo').strpath)
+    config.set(CONF_SECTION, 'outdir', tmpdir.join('out').strpath)
+    config.set(CONF_SECTION, 'cachedir', tmpdir.join('cache').strpath)
+    tmpdir.mkdir('out')
+    mocker.patch.object(updateSubscriptionDownloads, 'get_config',
+                        lambda: config)
+    return config
+
+
+@pytest.fixture
+def combine(mocker, repository):
+    """Record the combined files and let the test decide what fails."""
+    combine = mocker.Mock(return_value=[])
+
+    def combine_subscriptions(sources, target_dir, **kwargs):
+        if not os.path.isdir(target_dir):
+            os.makedirs(target_dir)
+        combine.inputs = {name: source.read_file('a.txt')
+                          for name, source in sources.iteritems()}
+        return combine.return_value
+
+    combine.side_effect = combine_subscriptions
+    mocker.patch.object(updateSubscriptionDownloads, 'combine_subscriptions',
+                        combine)
+    mocker.patch.object(updateSubscriptionDownloads,
+                        'remote_includes_changed', return_value=False)
+    return combine
+
+
+def test_snapshot_reused(tmpdir, repository):
+    cache_dir = tmpdir.join('cache').strpath
+    for i in range(2):
+        source = MercurialSnapshotSource('repo', cache_dir)
+        assert source.read_file('a.txt') == u'[Adblock Plus 2.0]\na1'
+        assert list(source.list_top_level_files()) == ['a.txt']
+    assert repository.archives == 1
+    assert os.listdir(cache_dir) == [repository.revision]
+
+
+def test_snapshot_revision_changed(tmpdir, repository):
+    cache_dir = tmpdir.join('cache').strpath
+    MercurialSnapshotSource('repo', cache_dir)
+
+    repository.revision = '2' * 40
+    repository.files['a.txt'] = u'[Adblock Plus 2.0]\na2'
+    source = MercurialSnapshotSource('repo', cache_dir)
+    assert source.read_file('a.txt') == u'[Adblock Plus 2.0]\na2'
+    assert repository.archives == 2
+    assert os.listdir(cache_dir) == [repository.revision]
+
+
+def test_unchanged_run_skipped(config, repository, combine):
+    update_subscription_downloads()
+    update_subscription_downloads()
+    assert combine.call_count == 1
+
+    updateSubscriptionDownloads.remote_includes_changed.return_value = True
+    update_subscription_downloads()
+    assert combine.call_count == 2
+
+
+def test_revision_change_combined(config, repository, combine):
+    update_subscription_downloads()
+
+    repository.revision = '2' * 40
+    repository.files['a.txt'] = u'[Adblock Plus 2.0]\na2'
+    update_subscription_downloads()
+    assert combine.call_count == 2
+    assert combine.inputs == {'test': u'[Adblock Plus 2.0]\na2'}
+
+
+def test_rerun_after_failure(config, repository, combine):
+    combine.return_value = ['a.txt']
+    update_subscription_downloads()
+    update_subscription_downloads()
+    assert combine.call_count == 2
+
+    combine.return_value = []
+    update_subscription_downloads()
+    update_subscription_downloads()
+    assert combine.call_count == 3
+
+
+def test_optimize_report_logged(config, repository, mocker):
+    config.set(CONF_SECTION, 'optimize', 'yes')
+    basic_config = mocker.patch.object(updateSubscriptionDownloads.logging,
+                                       'basicConfig')
+    mocker.patch.object(updateSubscriptionDownloads, 'combine_subscriptions',
+                        return_value=[])
+    update_subscription_downloads()
+    basic_config.assert_called_once()
+    assert basic_config.call_args[1]['level'] == logging.INFO
@@ -0,0 +1,233 @@
+# This file is part of the Adblock Plus web scripts,
+# Copyright (C) 2006-present eyeo GmbH
+#
+# Adblock Plus is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 3 as
+# published by the Free Software Foundation.
+#
+# Adblock Plus is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Adblock Plus.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Regression tests for the TPL converter.
+
+Run this file directly to benchmark the converter against the previous
+implementation on an EasyList-sized input.
+"""
+
+import itertools
+import re
+import sys
+import time
+
+import pytest
+
+from sitescripts.subscriptions.combineSubscriptions import write_tpl
+
+COMMENTS = [
+    u'! Title: EasyList',
+    u'!Expires: 4 days',
+    u'! Expires: 36h',
+    u'  ! expires :5 h',
+    u'! Expires: soon',
+    u'! ---------- General --------!',
+    u'!--!',
+    u'!',
+]
+
+ELEMHIDE = [
+    u'##.ad',
+    u'example.com##div#banner',
+    u'~example.com#@#.sponsored',
+]
+
+PREFIXES = [u'', u'@@']
+ANCHORS = [u'', u'|', u'||', u'|http://', u'|https://', u'|||']
+BODIES = [
+    u'example.com',
+    u'example.com/ads/',
+    u'ads.example.com:8080/banner*',
+    u'example.com^',
+    u'example.com^*/ *|',
+    u'example.com /',
+    u'/banner/*/img^',
+    u'/*ad*',
+    u'foo*',
+    u'ads|',
+    u'\u00e4rger.de/werbung',
+]
+OPTIONS = [
+    None, u'', u'script', u'third-party', u'~third-party', u'match_case',
+    u'image,script', u'script,other', u'other', u'elemhide', u'donottrack',
+    u'domain=example.com', u'domain=~example.com',
+    u'script,domain=~foo.com', u'SCRIPT,~THIRD_PARTY', u'image',
+    u'~third-party,image', u'other,elemhide', u'script,~other',
+    u'~donottrack,script,elemhide', u'$script',
+]
+
+
+def filters():
+    for prefix, anchor, body, options in itertools.product(PREFIXES, ANCHORS,
+                                                           BODIES, OPTIONS):
+        line = prefix + anchor + body
+        if options is not None:
+            line += u'$' + options
+        yield line
+
+
+def corpus(size=None):
+    lines = COMMENTS + ELEMHIDE + list(filters())
+    if size is None:
+        return lines
+    result = []
+    for i in itertools.count():
+        for line in lines:
+            result.append(line.replace(u'example', u'example%d' % i))
+            if len(result) == size:
+                return result
+
+
+def convert(converter, lines):
+    saved = {}
+
+    def save_file(filename, data):
+        if not isinstance(data, basestring):
+            data = ''.join(data)
+        saved[filename] = data.encode('utf-8')
+
+    converter(save_file, 'list.tpl', lines)
+    return saved['list.tpl']
+
+
+def legacy_write_tpl(save_file, filename, lines):
+    """Convert to TPL as before the converter was turned into a generator."""
+    result = []
+    result.append('msFilterList')
+    for line in lines:
+        if re.search(r'^\s*!', line):
+            # This is a comment. Handle "Expires" comment in a special way, keep the rest.
+            match = re.search(r'^\s*!\s*Expires\s*:\s*(\d+)\s*(h)?', line, re.I)
+            if match:
+                interval = int(match.group(1))
+                if match.group(2):
+                    interval = int(interval / 24)
+                result.append(': Expires=%i' % interval)
+            else:
+                result.append(re.sub(r'^\s*!', '#', re.sub(r'--!$', '--#', line)))
+        elif line.find('#') >= 0:
+            # Element hiding rules are not supported in MSIE, drop them
+            pass
+        else:
+            # We have a blocking or exception rule, try to convert it
+            origline = line
+
+            is_exception = False
+            if line.startswith('@@'):
+                is_exception = True
+                line = line[2:]
+
+            has_unsupported = False
+            requires_script = False
+            match = re.search(r'^(.*?)\$(.*)', line)
+            if match:
+                # This rule has options, check whether any of them are important
+                line = match.group(1)
+                options = match.group(2).replace('_', '-').lower().split(',')
+
+                # Remove first-party only exceptions, we will allow an ad server everywhere otherwise
+                if is_exception and '~third-party' in options:
+                    has_unsupported = True
+
+                # A number of options are not supported in MSIE but can be safely ignored, remove them
+                options = filter(lambda o: not o in ('', 'third-party', '~third-party', 'match-case', '~match-case', '~other', '~donottrack'), options)
+
+                # Also ignore domain negation of whitelists
+                if is_exception:
+                    options = filter(lambda o: not o.startswith('domain=~'), options)
+
+                unsupported = filter(lambda o: o in ('other', 'elemhide'), options)
+                if unsupported and len(unsupported) == len(options):
+                    # The rule only applies to types that are not supported in MSIE
+                    has_unsupported = True
+                elif 'donottrack' in options:
+                    # Do-Not-Track rules have to be removed even if $donottrack is combined with other options
+                    has_unsupported = True
+                elif 'script' in options and len(options) == len(unsupported) + 1:
+                    # Mark rules that only apply to scripts for approximate conversion
+                    requires_script = True
+                elif len(options) > 0:
+                    # The rule has further options that aren't available in TPLs. For
+                    # exception rules that aren't specific to a domain we ignore all
+                    # remaining options to avoid potential false positives. Other rules
+                    # simply aren't included in the TPL file.
+                    if is_exception:
+                        has_unsupported = any([o.startswith('domain=') for o in options])
+                    else:
+                        has_unsupported = True
+
+            if has_unsupported:
+                # Do not include filters with unsupported options
+                result.append('# ' + origline)
+            else:
+                line = line.replace('^', '/')  # Assume that separator placeholders mean slashes
+
+                # Try to extract domain info
+                domain = None
+                match = re.search(r'^(\|\||\|\w+://)([^*:/]+)(:\d+)?(/.*)', line)
+                if match:
+                    domain = match.group(2)
+                    line = match.group(4)
+                else:
+                    # No domain info, remove anchors at the rule start
+                    line = re.sub(r'^\|\|', 'http://', line)
+                    line = re.sub(r'^\|', '', line)
+                # Remove anchors at the rule end
+                line = re.sub(r'\|$', '', line)
+                # Remove unnecessary asterisks at the ends of lines
+                line = re.sub(r'\*$', '', line)
+                # Emulate $script by appending *.js to the rule
+                if requires_script:
+                    line += '*.js'
+                if line.startswith('/*'):
+                    line = line[2:]
+                if domain:
+                    line = '%sd %s %s' % ('+' if is_exception else '-', domain, line)
+                    line = re.sub(r'\s+/$', '', line)
+                    result.append(line)
+                elif is_exception:
+                    # Exception rules without domains are unsupported
+                    result.append('# ' + origline)
+                else:
+                    result.append('- ' + line)
+    save_file(filename, '\n'.join(result) + '\n')
+
+
+@pytest.mark.parametrize('lines', [
+    [],
+    COMMENTS,
+    ELEMHIDE,
+    list(filters()),
+    corpus(20000),
+])
+def test_same_output(lines):
+    assert convert(write_tpl, lines) == convert(legacy_write_tpl, lines)
+
+
+def benchmark(size=70000, runs=3):
+    lines = corpus(size)
+    for name, converter in [('legacy', legacy_write_tpl),
+                            ('current', write_tpl)]:
+        timings = []
+        for i in range(runs):
+            start = time.time()
+            convert(converter, lines)
+            timings.append(time.time() - start)
+        print '%-8s %d lines: %.3fs' % (name, size, min(timings))
+
+
+if __name__ == '__main__':
+    benchmark(*map(int, sys.argv[1:]))
@@ -19,11 +19,12 @@ import sys
 import os
 import re
 from sitescripts.utils import get_config, cached, setupStderr
-from sitescripts.web import url_handler
+from sitescripts.web import url_handler, cache_response
 import sitescripts.subscriptions.subscriptionParser as subscriptionParser
 
 
 @url_handler('/getSubscription')
+@cache_response(600, params=['url'])
 def handleSubscriptionFallbackRequest(environ, start_response):
     setupStderr(environ['wsgi.errors'])
 
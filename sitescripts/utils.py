@@ -17,11 +17,16 @@ import os
 import sys
 import re
 import codecs
+import email
+import smtplib
 import subprocess
+import threading
 import sitescripts
+from collections import OrderedDict
 from time import time
 from tempfile import mkstemp
 from ConfigParser import SafeConfigParser
+from email.utils import getaddresses, parseaddr
 
 siteScriptsPath = sitescripts.__path__[0]
 
@@ -29,26 +34,85 @@ siteScriptsPath = sitescripts.__path__[0]
 class cached(object):
     """
       Decorator that caches a function's return value for a given number of seconds.
-      Note that this only works if the string representation of the parameters is
-      always unique.
+      Note that this only works if the parameters are hashable and the string
+      representation of the keyword parameters is always unique.
+
+      At most max_size results are kept (None for no limit), the least recently
+      used ones are evicted first. Only one caller at a time calls the function
+      for the same parameters. While it does, other callers get the expired
+      result if there is one, otherwise they wait for the new result.
     """
 
-    def __init__(self, timeout):
+    def __init__(self, timeout, max_size=1024):
         self.timeout = timeout
-        self.lastResult = {}
-        self.lastUpdate = {}
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self.stale_hits = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._pending = {}
+        self._lock = threading.Lock()
+
+    def _lookup(self, key):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                self._entries[key] = entry
+                if time() - entry[1] <= self.timeout:
+                    self.hits += 1
+                    return entry, None
+            if key in self._pending:
+                if entry is not None:
+                    self.stale_hits += 1
+                    return entry, None
+                return None, self._pending[key]
+
+            self.misses += 1
+            self._pending[key] = threading.Event()
+            return None, None
+
+    def _store(self, key, entry):
+        with self._lock:
+            if entry is not None:
+                self._entries.pop(key, None)
+                self._entries[key] = entry
+                while self.max_size is not None and len(self._entries) > self.max_size:
+                    self._entries.popitem(last=False)
+                    self.evictions += 1
+            self._pending.pop(key).set()
 
     def __call__(self, func):
         def wrapped(*args, **kwargs):
-            key = str(kwargs)
-            currentTime = time()
-            if (args, key) not in self.lastUpdate or currentTime - self.lastUpdate[args, key] > self.timeout:
-                self.lastResult[args, key] = func(*args, **kwargs)
-                self.lastUpdate[args, key] = currentTime
-            return self.lastResult[args, key]
+            key = (args, str(sorted(kwargs.items())))
+            while True:
+                entry, pending = self._lookup(key)
+                if entry is not None:
+                    return entry[0]
+                if pending is None:
+                    break
+                pending.wait()
+
+            entry = None
+            try:
+                entry = (func(*args, **kwargs), time())
+            finally:
+                self._store(key, entry)
+            return entry[0]
         self.func = func
+        wrapped.cache = self
         return wrapped
 
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses,
+                    'stale_hits': self.stale_hits, 'evictions': self.evictions,
+                    'size': len(self._entries)}
+
     def __repr__(self):
         return repr(self.func)
 
@@ -113,16 +177,104 @@ def sendMail(template, data):
     template = get_template(template, False)
     mail = template.render(data)
     config = get_config()
-    if config.has_option('DEFAULT', 'mailerDebug') and config.get('DEFAULT', 'mailerDebug') == 'yes':
-        handle, path = mkstemp(prefix='mail_', suffix='.eml', dir='.')
-        os.close(handle)
-        f = codecs.open(path, 'wb', encoding='utf-8')
-        print >>f, mail
-        f.close()
+    if _isMailerDebug(config):
+        _writeDebugMail(mail)
     else:
         subprocess.Popen([config.get('DEFAULT', 'mailer'), '-t'], stdin=subprocess.PIPE).communicate(mail.encode('utf-8'))
 
 
+def sendMails(template, data_list):
+    """Send a mail generated from the template for each of the data given.
+
+    All mails are rendered first and then delivered through a single mailer
+    process, talking SMTP to it on its standard input and output (the
+    mailer's -bs mode) rather than starting a new mailer for every mail.
+    """
+    template = get_template(template, False)
+    mails = [template.render(data) for data in data_list]
+    if not mails:
+        return
+
+    config = get_config()
+    if _isMailerDebug(config):
+        for mail in mails:
+            _writeDebugMail(mail)
+        return
+
+    smtp = _MailerSMTP(config.get('DEFAULT', 'mailer'))
+    try:
+        for mail in mails:
+            message = email.message_from_string(mail.encode('utf-8'))
+            sender = parseaddr(message.get('From', ''))[1]
+            recipients = [address for name, address in getaddresses(
+                message.get_all('To', []) + message.get_all('Cc', []) +
+                message.get_all('Bcc', []),
+            ) if address]
+            if 'Bcc' in message:
+                del message['Bcc']
+                mail = message.as_string()
+            else:
+                mail = mail.encode('utf-8')
+
+            try:
+                smtp.sendmail(sender, recipients, mail)
+            except smtplib.SMTPServerDisconnected:
+                raise
+            except smtplib.SMTPException as error:
+                print >>sys.stderr, 'Failed to send mail to %s: %s' % (
+                    ', '.join(recipients), error,
+                )
+        smtp.quit()
+    finally:
+        smtp.close()
+
+
+def _isMailerDebug(config):
+    return (config.has_option('DEFAULT', 'mailerDebug') and
+            config.get('DEFAULT', 'mailerDebug') == 'yes')
+
+
+def _writeDebugMail(mail):
+    handle, path = mkstemp(prefix='mail_', suffix='.eml', dir='.')
+    os.close(handle)
+    f = codecs.open(path, 'wb', encoding='utf-8')
+    print >>f, mail
+    f.close()
+
+
+class _MailerConnection(object):
+    """Socket-like wrapper around a mailer process running in SMTP mode."""
+
+    def __init__(self, mailer):
+        self._process = subprocess.Popen([mailer, '-bs'],
+                                         stdin=subprocess.PIPE,
+                                         stdout=subprocess.PIPE)
+
+    def sendall(self, data):
+        self._process.stdin.write(data)
+        self._process.stdin.flush()
+
+    def makefile(self, mode='rb', bufsize=-1):
+        return self._process.stdout
+
+    def close(self):
+        if not self._process.stdin.closed:
+            self._process.stdin.close()
+            self._process.wait()
+
+
+class _MailerSMTP(smtplib.SMTP):
+    """SMTP client delivering through the mailer rather than a server."""
+
+    def __init__(self, mailer):
+        smtplib.SMTP.__init__(self, local_hostname='localhost')
+        self.sock = _MailerConnection(mailer)
+        code, message = self.getreply()
+        if code != 220:
+            self.close()
+            raise smtplib.SMTPConnectError(code, message)
+
+
 def encode_email_address(email):
     """
     Validates and encodes an email address.
@@ -14,18 +14,44 @@
 # along with Adblock Plus.  If not, see <http://www.gnu.org/licenses/>.
 
 import base64
+import bisect
+import hashlib
 import imp
 import importlib
-import re
+import itertools
 import httplib
+import threading
+import time
 import urllib
-from urlparse import parse_qsl
+import zlib
+from collections import OrderedDict
+from urlparse import parse_qs, parse_qsl
 
 from sitescripts.utils import get_config
 
 handlers = {}
 authenticated_users = {}
 
+# Upper bounds (in seconds) of the request latency histogram buckets
+latency_buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+# Request count, error count, total latency and latency histogram per url
+route_metrics = {}
+_metrics_lock = threading.Lock()
+
+# Responses smaller than this (in bytes) aren't compressed
+compression_min_size = 1024
+
+# Routing table compiled from handlers on the first request
+_routes = None
+
+# Modules to import on the first request to any of their urls, by url
+_lazy_routes = {}
+
+# Time (in seconds) it took to import each handler module
+module_load_times = {}
+_module_lock = threading.Lock()
+
 
 def url_handler(url):
     def decorator(func):
@@ -39,6 +65,9 @@ def registerUrlHandler(url, func):
         raise Exception('A handler for url %s is already registered' % url)
     handlers[url] = func
 
+    global _routes
+    _routes = None
+
 # https://www.python.org/dev/peps/pep-0333/#url-reconstruction
 
 
@@ -114,23 +143,400 @@ def form_handler(func):
     return wrapper
 
 
-def multiplex(environ, start_response):
-    try:
-        path = environ['PATH_INFO']
+def matches_etag(environ, etag):
+    if_none_match = environ.get('HTTP_IF_NONE_MATCH', '')
+    # Compressed variants have the ETag of the response with a suffix
+    tags = [tag.strip().replace('-gzip"', '"')
+            for tag in if_none_match.split(',')]
+    return etag in tags or '*' in tags
+
+
+def accepts_gzip(environ):
+    for coding in environ.get('HTTP_ACCEPT_ENCODING', '').split(','):
+        params = coding.split(';')
+        if params[0].strip().lower() not in ('gzip', 'x-gzip'):
+            continue
+        for param in params[1:]:
+            name, _, value = param.partition('=')
+            if name.strip() == 'q':
+                try:
+                    return float(value) > 0
+                except ValueError:
+                    return False
+        return True
+    return False
+
+
+def _gzip(chunks):
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+def _compressed_etag(etag):
+    if etag.endswith('"'):
+        return etag[:-1] + '-gzip"'
+    return etag
+
+
+def _vary_headers(headers):
+    # Responses of compressible handlers depend on Accept-Encoding even if
+    # they aren't compressed, otherwise caches would serve them to anyone.
+    result = []
+    vary = None
+    for name, value in headers:
+        if name.lower() == 'vary':
+            vary = [v.strip() for v in value.split(',') if v.strip()]
+        else:
+            result.append((name, value))
+    if vary is None:
+        vary = []
+    if 'accept-encoding' not in [v.lower() for v in vary] and '*' not in vary:
+        vary.append('Accept-Encoding')
+    result.append(('Vary', ', '.join(vary)))
+    return result
+
+
+def _compressed_headers(headers):
+    result = [('Content-Encoding', 'gzip')]
+    for name, value in headers:
+        if name.lower() == 'etag':
+            result.append((name, _compressed_etag(value)))
+        elif name.lower() != 'content-length':
+            result.append((name, value))
+    return _vary_headers(result)
+
+
+def _compress(func):
+    """Compress responses of a handler if the client accepts gzip.
+
+    Only successful responses of at least compression_min_size bytes that
+    aren't encoded already are compressed. The body is compressed while the
+    handler produces it, so large responses aren't kept in memory.
+    """
+    def compressing_handler(environ, start_response):
+        if not accepts_gzip(environ):
+            def vary_start_response(status, headers, *exc_info):
+                return start_response(status, _vary_headers(headers),
+                                      *exc_info)
+            return func(environ, vary_start_response)
+
+        response = []
+
+        def deferred_start_response(status, headers, exc_info=None):
+            response[:] = [status, headers]
+            return chunks.append
+
+        chunks = []
+        result = func(environ, deferred_start_response)
+        if isinstance(result, str):
+            result = [result]
+        iterator = iter(result)
+
+        # Handlers might only call start_response() when iterated over, and
+        # the size of the response might only be known after reading it.
+        size = 0
+        for chunk in iterator:
+            chunks.append(chunk)
+            size += len(chunk)
+            if response and size >= compression_min_size:
+                break
+        else:
+            iterator = iter([])
+
+        status, headers = response
+        if (status.startswith('200') and size >= compression_min_size and
+                not any(name.lower() == 'content-encoding'
+                        for name, value in headers)):
+            start_response(status, _compressed_headers(headers))
+            body = _gzip(itertools.chain(chunks, iterator))
+        else:
+            start_response(status, _vary_headers(headers))
+            body = itertools.chain(chunks, iterator)
+
+        def close_after(body):
+            try:
+                for chunk in body:
+                    yield chunk
+            finally:
+                if hasattr(result, 'close'):
+                    result.close()
+        return close_after(body)
+    return compressing_handler
+
+
+def cache_response(max_age, params=(), private=False, max_size=1024):
+    """Cache successful responses of a handler for max_age seconds.
+
+    Responses are cached per path and values of the given query parameters,
+    other parameters don't change the response. They are sent with an ETag
+    and a Cache-Control header allowing clients and proxies (only clients if
+    private is set) to cache them as well. Requests with a matching
+    If-None-Match header get a 304 response without body.
+    """
+    def decorator(func):
+        entries = OrderedDict()
+        lock = threading.Lock()
+
+        def render(environ):
+            response = []
+
+            def start_response(status, headers, exc_info=None):
+                response[:] = [status, headers]
+
+            result = func(environ, start_response)
+            try:
+                body = ''.join(result)
+            finally:
+                if hasattr(result, 'close'):
+                    result.close()
+            status, headers = response
+            etag = '"%s"' % hashlib.md5(body).hexdigest()
+            return status, headers, body, etag
+
+        def caching_wrapper(environ, start_response):
+            query = parse_qs(environ.get('QUERY_STRING', ''))
+            key = (environ.get('PATH_INFO', ''),
+                   tuple(tuple(query.get(param, [])) for param in params))
+            now = time.time()
+            with lock:
+                entry = entries.pop(key, None)
+                if entry is not None and now - entry['time'] < max_age:
+                    entries[key] = entry
+                else:
+                    entry = None
+
+            if entry is None:
+                status, headers, body, etag = render(environ)
+                entry = {'time': now, 'status': status, 'headers': headers,
+                         'body': body, 'etag': etag}
+                if status.startswith('200'):
+                    with lock:
+                        entries[key] = entry
+                        while len(entries) > max_size:
+                            entries.popitem(last=False)
+
+            status, headers, body = entry['status'], entry['headers'], entry['body']
+            if not status.startswith('200'):
+                start_response(status, _vary_headers(headers))
+                return [body]
+
+            etag = entry['etag']
+            if accepts_gzip(environ) and len(body) >= compression_min_size:
+                # Compress once and keep the result along with the response
+                if 'gzip' not in entry:
+                    entry['gzip'] = ''.join(_gzip([body]))
+                headers = _compressed_headers(headers)
+                body = entry['gzip']
+                etag = _compressed_etag(etag)
+
+            cache_control = '%s, max-age=%d' % (
+                'private' if private else 'public',
+                max(max_age - (now - entry['time']), 0))
+            cache_headers = [('ETag', etag), ('Cache-Control', cache_control)]
+            if matches_etag(environ, entry['etag']):
+                start_response('304 Not Modified',
+                               _vary_headers(cache_headers))
+                return []
+            start_response(status, _vary_headers(headers + cache_headers))
+            return [body]
+        return caching_wrapper
+    return decorator
+
+
+def _record_request(metrics, duration, error):
+    bucket = bisect.bisect_left(latency_buckets, duration)
+    with _metrics_lock:
+        metrics['requests'] += 1
+        metrics['errors'] += error
+        metrics['duration'] += duration
+        metrics['buckets'][bucket] += 1
+
+
+def _instrument(url, func):
+    metrics = route_metrics.setdefault(url, {
+        'requests': 0,
+        'errors': 0,
+        'duration': 0.0,
+        'buckets': [0] * (len(latency_buckets) + 1),
+    })
+
+    # Latency is measured until the handler returns the response body,
+    # responses produced while iterating over it aren't accounted for.
+    def instrumented_handler(environ, start_response):
+        status = []
+
+        def recording_start_response(status_line, *args):
+            status.append(status_line)
+            return start_response(status_line, *args)
+
+        start = time.time()
+        error = True
+        try:
+            response = func(environ, recording_start_response)
+            error = bool(status) and status[-1].startswith('5')
+            return response
+        finally:
+            _record_request(metrics, time.time() - start, error)
+    return instrumented_handler
+
+
+def _load_module(module):
+    with _module_lock:
+        if module in module_load_times:
+            return
+
+        start = time.time()
+        module_path = get_config().get('multiplexer', module)
+        if module_path:
+            imp.load_source(module, module_path)
+        else:
+            importlib.import_module(module)
+        module_load_times[module] = time.time() - start
+
+
+def _lazy_handler(url, module):
+    def loading_handler(environ, start_response):
+        _load_module(module)
         try:
-            handler = handlers[path]
+            handler = handlers[url]
         except KeyError:
-            handler = handlers[re.sub(r'[^/]+$', '', path)]
+            raise Exception('Module %s registered no handler for url %s' %
+                            (module, url))
+        return handler(environ, start_response)
+    return loading_handler
+
+
+def _compile_routes():
+    """Build the routing table for the registered handlers.
+
+    Returns a dict of handlers by url for exact matches, and a tree of url
+    path segments for longest-prefix matches. Each node of the tree maps
+    path segments to child nodes, and None to the handler registered for
+    the path up to that node, if the url ends with a slash.
+    """
+    routes = {url: _lazy_handler(url, module)
+              for url, module in _lazy_routes.iteritems()}
+    routes.update(handlers)
+
+    exact = {}
+    tree = {}
+    for url, func in routes.iteritems():
+        handler = exact[url] = _instrument(url, _compress(func))
+        if url.endswith('/'):
+            node = tree
+            for segment in url.split('/')[1:-1]:
+                node = node.setdefault(segment, {})
+            node[None] = handler
+    return exact, tree
+
+
+def _find_handler(routes, path):
+    exact, tree = routes
+    try:
+        return exact[path]
     except KeyError:
+        pass
+
+    node = tree
+    handler = node.get(None)
+    for segment in path.split('/')[1:-1]:
+        node = node.get(segment)
+        if node is None:
+            break
+        handler = node.get(None, handler)
+    return handler
+
+
+def _escape_label(value):
+    return value.replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n')
+
+
+def format_metrics():
+    """Return the metrics of all routes in Prometheus' text format."""
+    with _metrics_lock:
+        snapshot = [(_escape_label(url), dict(metrics,
+                                              buckets=list(metrics['buckets'])))
+                    for url, metrics in sorted(route_metrics.iteritems())]
+
+    lines = [
+        '# HELP sitescripts_requests_total Requests handled per route.',
+        '# TYPE sitescripts_requests_total counter',
+    ]
+    for route, metrics in snapshot:
+        lines.append('sitescripts_requests_total{route="%s"} %d' %
+                     (route, metrics['requests']))
+
+    lines += [
+        '# HELP sitescripts_request_errors_total Requests per route that '
+        'raised an exception or resulted in a 5xx status.',
+        '# TYPE sitescripts_request_errors_total counter',
+    ]
+    for route, metrics in snapshot:
+        lines.append('sitescripts_request_errors_total{route="%s"} %d' %
+                     (route, metrics['errors']))
+
+    lines += [
+        '# HELP sitescripts_request_duration_seconds Request latency per '
+        'route.',
+        '# TYPE sitescripts_request_duration_seconds histogram',
+    ]
+    for route, metrics in snapshot:
+        count = 0
+        bounds = [repr(float(bound)) for bound in latency_buckets] + ['+Inf']
+        for bound, bucket_count in zip(bounds, metrics['buckets']):
+            count += bucket_count
+            lines.append('sitescripts_request_duration_seconds_bucket'
+                         '{route="%s",le="%s"} %d' % (route, bound, count))
+        lines.append('sitescripts_request_duration_seconds_sum{route="%s"} %r'
+                     % (route, metrics['duration']))
+        lines.append('sitescripts_request_duration_seconds_count'
+                     '{route="%s"} %d' % (route, count))
+
+    lines += [
+        '# HELP sitescripts_module_load_seconds Time it took to import each '
+        'handler module.',
+        '# TYPE sitescripts_module_load_seconds gauge',
+    ]
+    for module, duration in sorted(module_load_times.items()):
+        lines.append('sitescripts_module_load_seconds{module="%s"} %r' %
+                     (_escape_label(module), duration))
+
+    return '\n'.join(lines) + '\n'
+
+
+def multiplex(environ, start_response):
+    global _routes
+    if _routes is None:
+        _routes = _compile_routes()
+
+    handler = _find_handler(_routes, environ.get('PATH_INFO', ''))
+    if handler is None:
         start_response('404 Not Found', [('Content-Type', 'text/plain')])
         return ['Not Found']
 
     return handler(environ, start_response)
 
 
-for module in set(get_config().options('multiplexer')) - set(get_config().defaults()):
-    module_path = get_config().get('multiplexer', module)
-    if module_path:
-        imp.load_source(module, module_path)
-    else:
-        importlib.import_module(module)
+def _declare_routes(config):
+    """Register the handler modules listed in the multiplexer section.
+
+    Modules whose urls are listed in the multiplexer_routes section are
+    imported on the first request to any of these urls, all other modules
+    are imported right away.
+    """
+    for module in set(config.options('multiplexer')) - set(config.defaults()):
+        if config.has_option('multiplexer_routes', module):
+            for url in config.get('multiplexer_routes', module).split():
+                _lazy_routes[url] = module
+        else:
+            _load_module(module)
+
+
+if get_config().has_option('multiplexer_compression', 'min_size'):
+    compression_min_size = get_config().getint('multiplexer_compression',
+                                               'min_size')
+_declare_routes(get_config())
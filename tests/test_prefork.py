@@ -0,0 +1,82 @@
+# This file is part of the Adblock Plus web scripts,
+# Copyright (C) 2006-present eyeo GmbH
+#
+# Adblock Plus is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 3 as
+# published by the Free Software Foundation.
+#
+# Adblock Plus is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Adblock Plus.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import signal
+import time
+import urllib2
+
+import pytest
+
+from sitescripts import prefork
+
+
+def load_app():
+    def app(environ, start_response):
+        start_response('200 OK', [('Content-Type', 'text/plain')])
+        return [str(os.getpid())]
+    return app
+
+
+@pytest.fixture
+def server():
+    sock = prefork.create_socket('127.0.0.1', 0)
+    url = 'http://127.0.0.1:%d/' % sock.getsockname()[1]
+    pid = os.fork()
+    if pid == 0:
+        try:
+            prefork.serve(sock, load_app, workers=2, threads=2,
+                          max_requests=3)
+        finally:
+            os._exit(0)
+
+    try:
+        sock.close()
+        yield pid, url
+    finally:
+        try:
+            os.kill(pid, signal.SIGTERM)
+            os.waitpid(pid, 0)
+        except OSError:
+            pass
+
+
+def get_worker_pids(url, count):
+    return [urllib2.urlopen(url, timeout=10).read() for i in range(count)]
+
+
+def test_max_requests(server):
+    master, url = server
+    pids = get_worker_pids(url, 12)
+    assert len(set(pids)) > 2
+    # The second thread of a worker might accept one more request
+    assert all(pids.count(pid) <= 4 for pid in pids)
+
+
+def test_reload(server):
+    master, url = server
+    old_pids = set(get_worker_pids(url, 2))
+    os.kill(master, signal.SIGHUP)
+    time.sleep(2)
+    assert not old_pids & set(get_worker_pids(url, 2))
+
+
+def test_stop(server):
+    master, url = server
+    get_worker_pids(url, 1)
+    os.kill(master, signal.SIGTERM)
+    os.waitpid(master, 0)
+    with pytest.raises(urllib2.URLError):
+        get_worker_pids(url, 1)
@@ -13,9 +13,52 @@
 # You should have received a copy of the GNU General Public License
 # along with Adblock Plus.  If not, see <http://www.gnu.org/licenses/>.
 
+import ConfigParser
+import json
+import stat
+import sys
+import threading
+
 import pytest
 
-from sitescripts.utils import get_template
+from sitescripts.utils import cached, get_template, sendMails
+
+# Minimal stand-in for `sendmail -bs`, recording the mails it receives
+# together with the pid of the mailer process that received them.
+FAKE_MAILER = '''#!{python}
+import json, os, sys
+
+log = open({log!r}, 'a')
+def reply(line):
+    sys.stdout.write(line + '\\r\\n')
+    sys.stdout.flush()
+
+reply('220 localhost')
+sender, recipients = None, []
+while True:
+    line = sys.stdin.readline()
+    if not line:
+        break
+    command = line.strip().upper()
+    if command.startswith('MAIL FROM:'):
+        sender, recipients = line.strip()[10:], []
+    elif command.startswith('RCPT TO:'):
+        recipients.append(line.strip()[8:])
+    if command == 'DATA':
+        reply('354 go ahead')
+        body = []
+        for line in iter(sys.stdin.readline, '.\\r\\n'):
+            body.append(line)
+        json.dump([os.getpid(), sender, recipients, ''.join(body)], log)
+        log.write('\\n')
+        log.flush()
+        reply('250 ok')
+    elif command == 'QUIT':
+        reply('221 bye')
+        break
+    else:
+        reply('250 ok')
+'''
 
 
 def test_get_template_default_path():
@@ -36,3 +79,127 @@ def test_get_template(tmpdir, mode):
         template = get_template('template.tmpl', template_path=tmpdir.strpath)
 
     assert template.render({'value': 1}) == 'value = 1'
+
+
+@pytest.fixture
+def clock(mocker):
+    clock = mocker.patch('sitescripts.utils.time')
+    clock.return_value = 0
+    return clock
+
+
+def test_cached_timeout(clock):
+    calls = []
+
+    @cached(10)
+    def func(value):
+        calls.append(value)
+        return value * 2
+
+    assert func(1) == 2
+    clock.return_value = 10
+    assert func(1) == 2
+    assert calls == [1]
+
+    clock.return_value = 11
+    assert func(1) == 2
+    assert calls == [1, 1]
+    assert func.cache.stats() == {'hits': 1, 'misses': 2, 'stale_hits': 0,
+                                  'evictions': 0, 'size': 1}
+
+
+def test_cached_lru_eviction(clock):
+    calls = []
+
+    @cached(10, max_size=2)
+    def func(value):
+        calls.append(value)
+        return value
+
+    func(1)
+    func(2)
+    func(1)
+    func(3)
+    func(1)
+    func(2)
+    assert calls == [1, 2, 3, 2]
+    assert func.cache.stats()['evictions'] == 2
+
+
+def test_cached_single_flight(clock):
+    started = threading.Event()
+    finish = threading.Event()
+    calls = []
+
+    @cached(10)
+    def func():
+        calls.append(None)
+        started.set()
+        finish.wait()
+        return len(calls)
+
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(func()))
+               for i in range(3)]
+    threads[0].start()
+    started.wait()
+    for thread in threads[1:]:
+        thread.start()
+    finish.set()
+    for thread in threads:
+        thread.join()
+    assert results == [1, 1, 1]
+
+    # Expired result is returned while it's being recomputed
+    clock.return_value = 20
+    started.clear()
+    finish.clear()
+    thread = threading.Thread(target=lambda: results.append(func()))
+    thread.start()
+    started.wait()
+    assert func() == 1
+    finish.set()
+    thread.join()
+    assert results[-1] == 2
+    assert func.cache.stats()['stale_hits'] == 1
+
+
+def test_cached_error_not_cached(clock):
+    calls = []
+
+    @cached(10)
+    def func():
+        calls.append(None)
+        if len(calls) == 1:
+            raise ValueError()
+        return len(calls)
+
+    with pytest.raises(ValueError):
+        func()
+    assert func() == 2
+
+
+def test_send_mails(tmpdir, mocker):
+    log = tmpdir.join('log')
+    mailer = tmpdir.join('mailer')
+    mailer.write(FAKE_MAILER.format(python=sys.executable, log=log.strpath))
+    mailer.chmod(stat.S_IRWXU)
+    tmpdir.join('mail.tmpl').write(
+        'From: sender@example.com\nTo: {{ to }}\nBcc: bcc@example.com\n'
+        'Subject: Hello\n\nHello {{ to }}\n',
+    )
+    config = ConfigParser.SafeConfigParser()
+    config.set('DEFAULT', 'mailer', mailer.strpath)
+    mocker.patch('sitescripts.utils.get_config', return_value=config)
+
+    sendMails(tmpdir.join('mail.tmpl').strpath,
+              [{'to': 'a@example.com'}, {'to': 'b@example.com'}])
+
+    mails = [json.loads(line) for line in log.readlines()]
+    assert len({pid for pid, sender, recipients, body in mails}) == 1
+    assert [mail[1:3] for mail in mails] == [
+        ['<sender@example.com>', ['<a@example.com>', '<bcc@example.com>']],
+        ['<sender@example.com>', ['<b@example.com>', '<bcc@example.com>']],
+    ]
+    assert 'Hello a@example.com' in mails[0][3]
+    assert 'Bcc' not in mails[0][3]
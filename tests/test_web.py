@@ -0,0 +1,297 @@
+# This file is part of the Adblock Plus web scripts,
+# Copyright (C) 2006-present eyeo GmbH
+#
+# Adblock Plus is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 3 as
+# published by the Free Software Foundation.
+#
+# Adblock Plus is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Adblock Plus.  If not, see <http://www.gnu.org/licenses/>.
+
+import sys
+import zlib
+from ConfigParser import SafeConfigParser
+
+import pytest
+
+from sitescripts import web
+
+
+@pytest.fixture(autouse=True)
+def handlers(monkeypatch):
+    monkeypatch.setattr(web, 'handlers', {})
+    monkeypatch.setattr(web, 'route_metrics', {})
+    monkeypatch.setattr(web, '_routes', None)
+
+    def register(url, status='200 OK'):
+        def handler(environ, start_response):
+            if status is None:
+                raise Exception('handler failed')
+            start_response(status, [])
+            return [url]
+        web.registerUrlHandler(url, handler)
+    return register
+
+
+def request(path):
+    statuses = []
+    body = web.multiplex({'PATH_INFO': path},
+                         lambda status, headers: statuses.append(status))
+    return statuses[0], ''.join(body)
+
+
+@pytest.mark.parametrize('path,expected', [
+    ('/exact', '/exact'),
+    ('/exact/', None),
+    ('/exactly', None),
+    ('/latest/', '/latest/'),
+    ('/latest/foo', '/latest/'),
+    ('/latest/foo/bar', '/latest/'),
+    ('/latest/nested/foo', '/latest/nested/'),
+    ('/latest/nested', '/latest/'),
+    ('/other/foo', None),
+])
+def test_routing(handlers, path, expected):
+    for url in ['/exact', '/latest/', '/latest/nested/']:
+        handlers(url)
+
+    status, body = request(path)
+    if expected is None:
+        assert status == '404 Not Found'
+    else:
+        assert status == '200 OK'
+        assert body == expected
+
+
+def test_handler_registered_after_first_request(handlers):
+    handlers('/foo')
+    assert request('/bar')[0] == '404 Not Found'
+
+    handlers('/bar')
+    assert request('/bar') == ('200 OK', '/bar')
+
+
+def test_metrics(handlers, monkeypatch):
+    handlers('/ok/')
+    handlers('/fail', status='500 Internal Server Error')
+    handlers('/raise', status=None)
+    times = iter([0, 0.003, 0, 0.2, 0, 20, 0, 0.01])
+    monkeypatch.setattr(web.time, 'time', lambda: next(times))
+
+    request('/ok/foo')
+    request('/ok/')
+    request('/fail')
+    with pytest.raises(Exception):
+        request('/raise')
+
+    lines = web.format_metrics().splitlines()
+    assert 'sitescripts_requests_total{route="/ok/"} 2' in lines
+    assert 'sitescripts_request_errors_total{route="/ok/"} 0' in lines
+    assert 'sitescripts_request_errors_total{route="/fail"} 1' in lines
+    assert 'sitescripts_request_errors_total{route="/raise"} 1' in lines
+    assert lines.index('# TYPE sitescripts_request_duration_seconds '
+                       'histogram') > 0
+
+    ok_buckets = [line for line in lines if line.startswith(
+        'sitescripts_request_duration_seconds_bucket{route="/ok/"')]
+    assert ok_buckets[0].endswith('le="0.005"} 1')
+    assert ok_buckets[3].endswith('le="0.05"} 1')
+    assert ok_buckets[4].endswith('le="0.1"} 1')
+    assert ok_buckets[5].endswith('le="0.25"} 2')
+    assert ok_buckets[-1].endswith('le="+Inf"} 2')
+    assert ('sitescripts_request_duration_seconds_count{route="/ok/"} 2'
+            in lines)
+    assert ('sitescripts_request_duration_seconds_bucket'
+            '{route="/fail",le="10.0"} 0' in lines)
+
+
+def test_lazy_loading(tmpdir, monkeypatch):
+    module = tmpdir.join('lazy_handler.py')
+    module.write('\n'.join([
+        'from sitescripts.web import url_handler',
+        '',
+        '',
+        "@url_handler('/lazy/')",
+        'def handler(environ, start_response):',
+        "    start_response('200 OK', [])",
+        "    return ['lazy']",
+    ]))
+    config = SafeConfigParser()
+    config.add_section('multiplexer')
+    config.set('multiplexer', 'lazy_handler', module.strpath)
+    config.add_section('multiplexer_routes')
+    config.set('multiplexer_routes', 'lazy_handler', '/lazy/ /unknown')
+    monkeypatch.setattr(web, 'get_config', lambda: config)
+    monkeypatch.setattr(web, '_lazy_routes', {})
+    monkeypatch.setattr(web, 'module_load_times', {})
+    monkeypatch.delitem(sys.modules, 'lazy_handler', raising=False)
+
+    web._declare_routes(config)
+    assert 'lazy_handler' not in sys.modules
+
+    assert request('/lazy/foo') == ('200 OK', 'lazy')
+    assert 'lazy_handler' in web.module_load_times
+    assert request('/lazy/') == ('200 OK', 'lazy')
+    with pytest.raises(Exception) as error:
+        request('/unknown')
+    assert 'registered no handler' in str(error.value)
+
+    assert 'sitescripts_requests_total{route="/lazy/"} 2' in \
+        web.format_metrics().splitlines()
+    assert 'sitescripts_module_load_seconds{module="lazy_handler"}' in \
+        web.format_metrics()
+
+
+def test_cache_response(monkeypatch):
+    calls = []
+
+    @web.cache_response(60, params=['a'])
+    def handler(environ, start_response):
+        calls.append(environ['QUERY_STRING'])
+        if 'fail' in environ['QUERY_STRING']:
+            start_response('500 Internal Server Error', [])
+            return ['error']
+        start_response('200 OK', [('Content-Type', 'text/plain')])
+        return iter(['response ', str(len(calls))])
+
+    def request(query, **headers):
+        environ = dict(headers, PATH_INFO='/', QUERY_STRING=query)
+        response = []
+        body = ''.join(handler(environ, lambda status, headers:
+                               response.extend([status, dict(headers)])))
+        return response[0], response[1], body
+
+    monkeypatch.setattr(web.time, 'time', lambda: 1000)
+    status, headers, body = request('a=1&b=1')
+    assert (status, body) == ('200 OK', 'response 1')
+    assert headers['Cache-Control'] == 'public, max-age=60'
+    etag = headers['ETag']
+
+    monkeypatch.setattr(web.time, 'time', lambda: 1030)
+    status, headers, body = request('b=2&a=1')
+    assert (status, body) == ('200 OK', 'response 1')
+    assert headers['ETag'] == etag
+    assert headers['Cache-Control'] == 'public, max-age=30'
+    assert request('a=1', HTTP_IF_NONE_MATCH=etag) == (
+        '304 Not Modified',
+        {'ETag': etag, 'Cache-Control': 'public, max-age=30',
+         'Vary': 'Accept-Encoding'}, '')
+    assert request('a=2')[2] == 'response 2'
+    assert calls == ['a=1&b=1', 'a=2']
+
+    assert request('a=fail')[:2] == ('500 Internal Server Error',
+                                     {'Vary': 'Accept-Encoding'})
+    assert request('a=fail')[2] == 'error'
+    assert len(calls) == 4
+
+    monkeypatch.setattr(web.time, 'time', lambda: 1060)
+    status, headers, body = request('a=1', HTTP_IF_NONE_MATCH=etag)
+    assert (status, body) == ('200 OK', 'response 5')
+    assert headers['ETag'] != etag
+
+
+@pytest.mark.parametrize('accept_encoding,expected', [
+    ('', False),
+    ('gzip', True),
+    ('deflate, gzip;q=0.5', True),
+    ('GZIP', True),
+    ('gzip;q=0', False),
+    ('identity', False),
+])
+def test_accepts_gzip(accept_encoding, expected):
+    environ = {'HTTP_ACCEPT_ENCODING': accept_encoding}
+    assert web.accepts_gzip(environ) == expected
+
+
+def gzip_request(path, **headers):
+    response = []
+    environ = dict(headers, PATH_INFO=path, HTTP_ACCEPT_ENCODING='gzip')
+    body = ''.join(web.multiplex(environ, lambda status, headers:
+                                 response.extend([status, dict(headers)])))
+    if response[1].get('Content-Encoding') == 'gzip':
+        body = zlib.decompress(body, 16 + zlib.MAX_WBITS)
+    return response[0], response[1], body
+
+
+def test_compression(monkeypatch):
+    monkeypatch.setattr(web, 'compression_min_size', 100)
+
+    def large(environ, start_response):
+        start_response('200 OK', [('Content-Length', '1000'),
+                                  ('ETag', '"etag"')])
+        return ['x' * 10] * 100
+
+    def small(environ, start_response):
+        start_response('200 OK', [])
+        return 'x' * 99
+
+    def streamed(environ, start_response):
+        start_response('200 OK', [])
+        for i in range(100):
+            yield 'line %d\n' % i
+
+    def error(environ, start_response):
+        start_response('500 Internal Server Error', [])
+        return ['x' * 1000]
+
+    for func in [large, small, streamed, error]:
+        web.registerUrlHandler('/' + func.__name__, func)
+
+    status, headers, body = gzip_request('/large')
+    assert body == 'x' * 1000
+    assert headers == {'Content-Encoding': 'gzip', 'Vary': 'Accept-Encoding',
+                       'ETag': '"etag-gzip"'}
+
+    status, headers, body = gzip_request('/small')
+    assert (headers, body) == ({'Vary': 'Accept-Encoding'}, 'x' * 99)
+
+    status, headers, body = gzip_request('/streamed')
+    assert headers['Content-Encoding'] == 'gzip'
+    assert body == ''.join('line %d\n' % i for i in range(100))
+
+    status, headers, body = gzip_request('/error')
+    assert (headers, body) == ({'Vary': 'Accept-Encoding'}, 'x' * 1000)
+
+    response = []
+    web.multiplex({'PATH_INFO': '/large'},
+                  lambda status, headers: response.append(dict(headers)))
+    assert response == [{'Content-Length': '1000', 'ETag': '"etag"',
+                         'Vary': 'Accept-Encoding'}]
+
+
+def test_cache_response_compressed(monkeypatch):
+    monkeypatch.setattr(web, 'compression_min_size', 100)
+    calls = []
+
+    @web.url_handler('/cached')
+    @web.cache_response(60)
+    def handler(environ, start_response):
+        calls.append(None)
+        start_response('200 OK', [('Content-Type', 'text/plain')])
+        return ['x' * 1000]
+
+    status, headers, body = gzip_request('/cached')
+    assert body == 'x' * 1000
+    assert headers['Content-Encoding'] == 'gzip'
+    etag = headers['ETag']
+    assert etag.endswith('-gzip"')
+
+    assert gzip_request('/cached')[2] == body
+    assert gzip_request('/cached', HTTP_IF_NONE_MATCH=etag)[0] == \
+        '304 Not Modified'
+    assert request('/cached')[1] == body
+    assert len(calls) == 1
+
+
+def test_vary_header_merged(monkeypatch):
+    @web.url_handler('/vary')
+    def handler(environ, start_response):
+        start_response('200 OK', [('Vary', 'Cookie')])
+        return ['x']
+
+    assert gzip_request('/vary')[1] == {'Vary': 'Cookie, Accept-Encoding'}